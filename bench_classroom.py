@@ -0,0 +1,476 @@
+"""교실 단위 부하 테스트: N명의 학생이 page_1 → page_4 흐름을 동시에 진행한다.
+
+실제 OpenAI / MongoDB / MySQL 대신 지연 시간을 조절할 수 있는 로컬 대역을 사용한다.
+
+    python bench_classroom.py --students 30 --turns 3 --ttft 0.4 --token-delay 0.01
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(ROOT, "inq_model01.py")
+# streamlit run과 달리 AppTest는 스크립트 폴더를 import 경로에 넣지 않는다
+sys.path.insert(0, ROOT)
+
+
+# --- 모의 OpenAI 호환 서버 ---
+
+class MockLLMConfig:
+    ttft = 0.4          # 첫 토큰까지의 지연 (초)
+    token_delay = 0.01  # 토큰 사이 지연 (초)
+    tokens = 40         # 응답 토큰 수
+    prompt_tokens = 1200
+    cached_tokens = 1024
+    error_rate = 0.0    # 이 비율만큼 429(Retry-After 포함)로 응답
+    failing_models = () # 이 모델 요청은 항상 503 (대체 모델 확인용)
+    leak_rate = 0.0     # 이 비율의 힌트 응답 중간에 최종 답($$ x = 3 $$)을 섞음 (inq_guard 확인용)
+    judge_requests = 0
+    requests = 0
+    rate_limited = 0
+    requests_by_model = {}
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = MockLLMConfig
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = body.get("model", "mock")
+        MockLLMConfig.requests += 1
+        MockLLMConfig.requests_by_model[model] = MockLLMConfig.requests_by_model.get(model, 0) + 1
+        if model in self.config.failing_models:
+            payload = json.dumps({"error": {"message": "Service overloaded", "type": "server_error"}}).encode()
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        if random.random() < self.config.error_rate:
+            MockLLMConfig.rate_limited += 1
+            payload = json.dumps({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}).encode()
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Retry-After", "0.2")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        usage = {
+            "prompt_tokens": self.config.prompt_tokens,
+            "completion_tokens": self.config.tokens,
+            "total_tokens": self.config.prompt_tokens + self.config.tokens,
+            "prompt_tokens_details": {"cached_tokens": self.config.cached_tokens},
+        }
+        words = [f"힌트{i} " for i in range(self.config.tokens)]
+        messages = body.get("messages") or [{}]
+        if str(messages[0].get("content", "")).startswith("너는 수학 튜터 챗봇의 응답을 검사"):
+            MockLLMConfig.judge_requests += 1
+            words = ['{"leak": true, "reason": "최종 답을 그대로 제시함"}']
+        elif random.random() < self.config.leak_rate:
+            half = len(words) // 2
+            words[half:half] = ["따라서 ", "정답은 ", "$$ x ", "= 3 ", "$$ ", "입니다. "]
+        time.sleep(self.config.ttft)
+
+        if not body.get("stream"):
+            time.sleep(self.config.token_delay * self.config.tokens)
+            payload = json.dumps({
+                "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(words)}}],
+                "usage": usage,
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(data):
+            raw = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+            self.wfile.flush()
+
+        base = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        for word in words:
+            send(json.dumps({**base, "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}))
+            time.sleep(self.config.token_delay)
+        send(json.dumps({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send(json.dumps({**base, "choices": [], "usage": usage}))
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start_mock_llm():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockLLMHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- DB 대역 (저장소 백엔드) ---
+
+class StandInStore:
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.documents = []
+        self.flags = []
+        self.write_latencies = []   # insert 호출 자체의 소요 시간
+        self.queue_latencies = []   # 저장 요청(document["time"])부터 기록 완료까지
+
+    def _record(self, docs, started):
+        time.sleep(self.latency)
+        done = time.time()
+        with self.lock:
+            self.documents.extend(docs)
+            self.write_latencies.append(time.perf_counter() - started)
+            for doc in docs:
+                if hasattr(doc.get("time"), "timestamp"):
+                    self.queue_latencies.append(done - doc["time"].timestamp())
+
+    # inq_storage.StorageBackend의 저장 메서드만 제공
+    def write_transcripts(self, records):
+        self._record(list(records), time.perf_counter())
+
+    def write_feedback(self, records):
+        self._record(list(records), time.perf_counter())
+
+    def write_flags(self, records):
+        with self.lock:
+            self.flags.extend(records)
+
+    def ensure_schema(self):
+        pass
+
+
+def install_stand_ins(store):
+    import inq_persist
+
+    inq_persist.get_storage = lambda: store
+
+
+# --- 학생 한 명의 흐름 ---
+
+# 같은 학습지 문제를 학생마다 조금씩 다르게 붙여 넣은 첫 질문 (--shared-opening)
+SHARED_OPENINGS = [
+    "$x^2 - 5x + 6 = 0$ 의 해를 구하는 방법을 알려줘",
+    "$$x^2-5x+6=0$$의 해를 구하는 방법을 알려줘",
+    "\\(x^2 - 5x + 6 = 0\\) 의 해를 구하는 방법을 알려주세요",
+    "x^2 - 5x + 6 = 0 의 해를 구하는 방법을 알려줘",
+]
+
+def make_secrets(base_url, workdir):
+    return {
+        "OPENAI_API_KEY": "mock-key",
+        "OPENAI_BASE_URL": base_url,
+        # --storage sqlite일 때만 실제로 사용 (기본은 DB 대역)
+        "STORAGE_BACKEND": "sqlite",
+        "STORAGE_PATH": os.path.join(workdir, "bench_storage.sqlite3"),
+        "PERSIST_JOURNAL_PATH": os.path.join(workdir, "bench_journal.jsonl"),
+        "METRICS_LOG_PATH": os.path.join(workdir, "bench_metrics.jsonl"),
+        "SESSION_OFFLOAD_DIR": os.path.join(workdir, "sessions"),
+    }
+
+
+def _button(at, label):
+    for button in at.button:
+        if button.label == label and not button.disabled:
+            return button
+    raise RuntimeError(f"'{label}' 버튼을 찾을 수 없습니다.")
+
+
+def _run(at):
+    at.run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+
+
+def make_app_test_class():
+    from streamlit.runtime.scriptrunner import ScriptRunnerEvent
+    from streamlit.testing.v1 import AppTest
+    from streamlit.testing.v1.element_tree import parse_tree_from_messages
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+    # 실제 서버처럼 컴파일된 스크립트를 모든 세션이 공유 (스레드마다 compile()을 반복하지 않음)
+    script_cache = ScriptCache()
+
+    class ConcurrentAppTest(AppTest):
+        # AppTest._run은 실행할 때마다 전역 Runtime/secrets를 바꿨다가 되돌리므로 동시에 돌릴 수 없다.
+        # install_runtime()으로 한 번 설정한 모의 런타임과 secrets를 모든 세션이 공유하게 한다.
+        def _run(self, widget_state=None, timeout=None):
+            if timeout is None:
+                timeout = self.default_timeout
+            script_runner = LocalScriptRunner(self._script_path, self.session_state)
+            script_runner._script_cache = script_cache
+            script_runner.run(widget_state, self.query_params, timeout)
+            # AppTest는 st.rerun으로 중단된 시점을 완료로 보므로, 스크립트 스레드가 끝날 때까지 기다리고
+            # 마지막 실행(SCRIPT_STARTED 이후)의 메시지만으로 화면을 구성한다
+            script_runner.join()
+            messages = []
+            for event, data in zip(script_runner.events, script_runner.event_data):
+                if event == ScriptRunnerEvent.SCRIPT_STARTED:
+                    messages = []
+                elif event == ScriptRunnerEvent.ENQUEUE_FORWARD_MSG:
+                    messages.append(data["forward_msg"])
+            self._tree = parse_tree_from_messages(messages)
+            self._tree._runner = self
+            return self
+
+    return ConcurrentAppTest
+
+
+def install_runtime(secrets):
+    from unittest.mock import MagicMock
+
+    import streamlit as st
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.secrets import Secrets
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+
+    shared_secrets = Secrets([])
+    shared_secrets._secrets = dict(secrets)
+    st.secrets = shared_secrets
+    config.set_option("runner.postScriptGC", False)
+
+
+def simulate_student(app_test_class, index, turns, timeout, shared_opening=False, start_delay=0.0):
+    from inq_cache import approx_size
+
+    at = app_test_class(APP_PATH, default_timeout=timeout)
+    result = {"turn_latencies": [], "page_latencies": {}, "errors": []}
+    time.sleep(start_delay)
+    try:
+        started = time.perf_counter()
+        _run(at)
+        at.text_input[0].input(f"{10000 + index}")
+        at.text_input[1].input(f"학생{index}")
+        _button(at, "다음").click()
+        _run(at)
+        result["page_latencies"]["page_1"] = time.perf_counter() - started
+
+        _button(at, "다음").click()
+        _run(at)
+
+        for turn in range(turns):
+            # 학생마다 다른 문제 (같은 요청은 게이트웨이에서 하나로 병합되므로)
+            prompt = f"$x^2 - {turn + 2}x + {index + 1} = 0$ 의 해를 구하는 방법을 알려줘"
+            if turn == 0 and shared_opening:
+                prompt = SHARED_OPENINGS[index % len(SHARED_OPENINGS)]
+            at.text_area[0].input(prompt)
+            _button(at, "전송").click()
+            turn_started = time.perf_counter()
+            _run(at)
+            result["turn_latencies"].append(time.perf_counter() - turn_started)
+
+        _button(at, "마침").click()
+        finish_started = time.perf_counter()
+        _run(at)
+        result["turn_latencies"].append(time.perf_counter() - finish_started)
+
+        _button(at, "다음").click()
+        page4_started = time.perf_counter()
+        _run(at)
+        result["page_latencies"]["page_4"] = time.perf_counter() - page4_started
+        result["session_bytes"] = approx_size(at.session_state.filtered_state)
+    except Exception as e:
+        result["errors"].append(str(e))
+    return result
+
+
+def _count_stored():
+    from inq_storage import get_storage
+
+    records, _ = get_storage().list_records(limit=100000)
+    return len(records)
+
+
+def _count_flags():
+    from inq_storage import get_storage
+
+    return len(get_storage().list_flags(limit=100000))
+
+
+# --- 집계 ---
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(name, values):
+    return {
+        "name": name,
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="수학여행 도우미 교실 부하 테스트")
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--turns", type=int, default=3, help="학생당 [전송] 횟수 ([마침] 제외)")
+    parser.add_argument("--ttft", type=float, default=0.4)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--db-latency", type=float, default=0.02)
+    parser.add_argument("--storage", choices=["stand-in", "sqlite"], default="stand-in",
+                        help="DB 대역 대신 실제 SQLite 저장소 백엔드를 사용")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="모의 서버가 429로 응답할 비율")
+    parser.add_argument("--fail-model", action="append", default=[], help="모의 서버가 항상 503으로 응답할 모델")
+    parser.add_argument("--leak-rate", type=float, default=0.0, help="모의 힌트 응답에 최종 답을 섞는 비율")
+    parser.add_argument("--offline", action="store_true", help="LLM_OFFLINE: 모든 호출을 로컬 서버(LOCAL_LLM_BASE_URL)로")
+    parser.add_argument("--rpm", type=float, default=6000, help="OPENAI_RPM_LIMIT (게이트웨이 분당 요청 한도)")
+    parser.add_argument("--concurrency", type=int, default=64, help="OPENAI_MAX_CONCURRENCY")
+    parser.add_argument("--ramp", type=float, default=0.0, help="학생들이 이 시간(초)에 걸쳐 나누어 입장")
+    parser.add_argument("--shared-opening", action="store_true", help="모든 학생이 같은 학습지 문제로 시작")
+    parser.add_argument("--hint-cache", action="store_true", help="HINT_CACHE_ENABLED를 켬")
+    parser.add_argument("--no-stream", action="store_true", help="STREAM_RESPONSES를 끄고 측정")
+    parser.add_argument("--trace", action="store_true", help="TRACING_ENABLED를 켜고 단계별 span 집계를 출력")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--workdir", help="저널/메트릭 파일을 둘 폴더 (기본: 임시 폴더)")
+    parser.add_argument("--json", help="결과를 JSON 파일로 저장")
+    args = parser.parse_args()
+
+    MockLLMConfig.ttft = args.ttft
+    MockLLMConfig.token_delay = args.token_delay
+    MockLLMConfig.tokens = args.tokens
+    MockLLMConfig.error_rate = args.error_rate
+    MockLLMConfig.failing_models = tuple(args.fail_model)
+    MockLLMConfig.leak_rate = args.leak_rate
+
+    server = start_mock_llm()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    store = StandInStore(args.db_latency)
+    if args.storage == "stand-in":
+        install_stand_ins(store)
+    secrets = make_secrets(base_url, args.workdir or tempfile.mkdtemp(prefix="inq_bench_"))
+    secrets["STREAM_RESPONSES"] = not args.no_stream
+    secrets["TRACING_ENABLED"] = args.trace
+    secrets["OPENAI_RPM_LIMIT"] = args.rpm
+    secrets["HINT_CACHE_ENABLED"] = args.hint_cache
+    secrets["OPENAI_MAX_CONCURRENCY"] = args.concurrency
+    if args.offline:
+        # 모의 서버를 교실 로컬 서버로 보고 모든 호출을 보냄 (OpenAI 주소는 닫힌 포트)
+        secrets.update({
+            "LLM_OFFLINE": True, "LOCAL_LLM_BASE_URL": base_url, "LOCAL_LLM_MODEL": "llama3.1",
+            "LOCAL_LLM_MAX_CONCURRENCY": args.concurrency, "OPENAI_BASE_URL": "http://127.0.0.1:9/v1",
+        })
+    install_runtime(secrets)
+    app_test_class = make_app_test_class()
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.students) as pool:
+        results = list(pool.map(
+            lambda i: simulate_student(
+                app_test_class, i, args.turns, args.timeout, args.shared_opening, args.ramp * i / max(args.students, 1)
+            ), range(args.students)
+        ))
+    elapsed = time.perf_counter() - started
+
+    # 백그라운드 저장이 끝날 때까지 대기
+    from inq_persist import get_persistence_worker
+    worker = get_persistence_worker()
+    deadline = time.time() + 30
+    while worker.pending() and time.time() < deadline:
+        time.sleep(0.1)
+    time.sleep(1.0)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    server.shutdown()
+
+    turn_latencies = [t for r in results for t in r["turn_latencies"]]
+    errors = [e for r in results for e in r["errors"]]
+    session_bytes = [r["session_bytes"] for r in results if "session_bytes" in r]
+    report = {
+        "students": args.students,
+        "turns_per_student": args.turns + 1,
+        "streaming": not args.no_stream,
+        "elapsed_s": elapsed,
+        "throughput_turns_per_s": len(turn_latencies) / elapsed if elapsed else 0.0,
+        "turn_latency_s": summarize("turn", turn_latencies),
+        "page4_latency_s": summarize("page_4", [r["page_latencies"].get("page_4", 0.0) for r in results if not r["errors"]]),
+        "db_write_latency_s": summarize("db_write", store.write_latencies),
+        "db_enqueue_to_write_s": summarize("db_queue", store.queue_latencies),
+        "documents_written": len(store.documents) if args.storage == "stand-in" else _count_stored(),
+        "llm_requests": MockLLMConfig.requests,
+        "llm_rate_limited": MockLLMConfig.rate_limited,
+        "llm_requests_by_model": dict(MockLLMConfig.requests_by_model),
+        "guard_judge_requests": MockLLMConfig.judge_requests,
+        "guard_flags_written": len(store.flags) if args.storage == "stand-in" else _count_flags(),
+        "session_state_bytes_avg": statistics.mean(session_bytes) if session_bytes else 0,
+        # Linux에서 ru_maxrss 단위는 KB
+        "rss_growth_per_session_kb": (rss_after - rss_before) / max(args.students, 1),
+        "errors": errors[:10],
+        "error_count": len(errors),
+    }
+
+    print(f"학생 {args.students}명 × {args.turns + 1}턴, 스트리밍={'켜짐' if not args.no_stream else '꺼짐'}")
+    print(f"전체 {elapsed:.2f}s, 처리량 {report['throughput_turns_per_s']:.2f} 턴/s, 오류 {len(errors)}건")
+    for key in ("turn_latency_s", "page4_latency_s", "db_write_latency_s", "db_enqueue_to_write_s"):
+        row = report[key]
+        print(f"  {key:<24} n={row['count']:<5} p50={row['p50']:.3f} p95={row['p95']:.3f} p99={row['p99']:.3f} max={row['max']:.3f}")
+    print(f"  세션 상태 평균 {report['session_state_bytes_avg'] / 1024:.1f} KB, "
+          f"세션당 RSS 증가 {report['rss_growth_per_session_kb']:.0f} KB, 저장 문서 {report['documents_written']}건")
+    print(f"  모의 LLM 요청 {report['llm_requests']}건 (429 응답 {report['llm_rate_limited']}건), "
+          f"모델별 {report['llm_requests_by_model']}")
+    print(f"  정답 노출 판정 요청 {report['guard_judge_requests']}건, 기록된 의심 턴 {report['guard_flags_written']}건")
+    for error in errors[:5]:
+        print(f"  오류: {error}")
+
+    if args.trace:
+        from inq_metrics import load_events, summarize_spans, summarize_usage
+        report["spans"] = summarize_spans(load_events(secrets["METRICS_LOG_PATH"], event_type="span"))
+        report["usage_by_model"] = summarize_usage(load_events(secrets["METRICS_LOG_PATH"], event_type="usage"), ("call", "model"))
+        for row in report["usage_by_model"]:
+            print(f"  usage {row['call']:<16} {row['model']:<14} n={row['requests']:<5} "
+                  f"cost=${row['cost_usd']:.4f} p50={row['p50_ms']}ms p95={row['p95_ms']}ms")
+        for row in report["spans"]:
+            print(f"  span {row['name']:<24} n={row['count']:<5} p50={row['p50_ms']:.1f}ms "
+                  f"p95={row['p95_ms']:.1f}ms p99={row['p99_ms']:.1f}ms")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""앱 시작 시간 측정: 새 프로세스에서 import 시간과 첫 화면 렌더링 시간을 잰다.
+
+외부 서비스에는 연결하지 않는다 (저장소는 임시 폴더의 SQLite 사용).
+
+    python bench_startup.py --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ["openai", "httpx", "pymongo", "pymysql", "sqlalchemy", "dotenv", "tiktoken"]
+
+
+def _secrets(workdir):
+    return {
+        "OPENAI_API_KEY": "startup-bench",
+        # 두 앱이 같은 로컬 SQLite 저장소를 사용
+        "STORAGE_BACKEND": "sqlite",
+        "STORAGE_PATH": os.path.join(workdir, "startup.sqlite3"),
+        "PERSIST_JOURNAL_PATH": os.path.join(workdir, "journal.jsonl"),
+        "METRICS_LOG_PATH": os.path.join(workdir, "metrics.jsonl"),
+        "SESSION_OFFLOAD_DIR": os.path.join(workdir, "sessions"),
+        "PASSWORD": "startup-bench",
+    }
+
+
+def _timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def _check(at):
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+
+
+def child(app, workdir):
+    # 측정 대상 프로세스: 결과를 JSON 한 줄로 출력
+    sys.path.insert(0, ROOT)
+    timings = {}
+    timings["import_streamlit"] = _timed(lambda: __import__("streamlit.testing.v1"))
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, app), default_timeout=60)
+    at.secrets.update(_secrets(workdir))
+
+    timings["first_render"] = _timed(at.run)
+    _check(at)
+    loaded_first = [m for m in HEAVY_MODULES if m in sys.modules]
+    timings["rerun"] = _timed(at.run)
+    _check(at)
+
+    if app == "inq_model01.py":
+        # 학번/이름을 입력한 상태로 대화 화면(page_3)을 처음 렌더링
+        at.session_state["user_number"] = "10101"
+        at.session_state["user_name"] = "학생"
+        at.session_state["step"] = 3
+        timings["chat_page_first_render"] = _timed(at.run)
+    else:
+        # 비밀번호 입력 후 목록 화면 (DB 연결 포함)
+        at.text_input[0].input("startup-bench")
+        timings["list_page_first_render"] = _timed(at.run)
+    _check(at)
+
+    print(json.dumps({
+        "timings": timings,
+        "heavy_modules_after_first_render": loaded_first,
+        "heavy_modules_at_end": [m for m in HEAVY_MODULES if m in sys.modules],
+    }))
+
+
+def measure(app, repeat, workdir):
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", app, "--workdir", workdir],
+            cwd=workdir, capture_output=True, text=True, check=True,
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        result["timings"]["process_total"] = time.perf_counter() - started
+        runs.append(result)
+    keys = runs[0]["timings"].keys()
+    return {
+        "app": app,
+        "median_s": {k: statistics.median(r["timings"][k] for r in runs) for k in keys},
+        "heavy_modules_after_first_render": runs[0]["heavy_modules_after_first_render"],
+        "heavy_modules_at_end": runs[0]["heavy_modules_at_end"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="수학여행 도우미 앱 시작 시간 측정")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--apps", nargs="+", default=["inq_model01.py", "inq_eval.py"])
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--json", help="결과를 JSON 파일로 저장")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.workdir)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="inq_startup_")
+    report = [measure(app, args.repeat, workdir) for app in args.apps]
+    for result in report:
+        print(f"{result['app']} (중앙값, {args.repeat}회)")
+        for key, value in result["median_s"].items():
+            print(f"  {key:<26} {value * 1000:8.1f} ms")
+        print(f"  첫 화면 후 로드된 무거운 모듈: {', '.join(result['heavy_modules_after_first_render']) or '없음'}")
+        print(f"  마지막 화면 후: {', '.join(result['heavy_modules_at_end']) or '없음'}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
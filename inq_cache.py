@@ -0,0 +1,229 @@
+import hashlib
+import math
+import re
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+
+# --- CACHE (TTL + LRU, 메모리 상한) ---
+# 여러 세션이 공유하는 조회 결과 캐시. 항목마다 만료 시간을 두고,
+# 전체 크기(추정 바이트)가 상한을 넘으면 가장 오래 사용되지 않은 항목부터 제거한다.
+# 키는 (namespace, ...) 튜플을 사용하여 namespace 단위로 무효화할 수 있다.
+
+
+def approx_size(value):
+    # 정확한 크기보다 빠른 추정이 목적: 컨테이너는 재귀적으로 더함
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(approx_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class TTLLRUCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_ttl=60.0, on_evict=None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        # on_evict(key): 항목이 만료·제거·교체될 때 (잠금을 잡은 상태에서) 호출
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # (적중 여부, 값)을 반환. None도 정상 값으로 캐시할 수 있도록 분리
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def set(self, key, value, ttl=None):
+        # 저장했으면 True (상한보다 큰 값은 저장하지 않음)
+        size = approx_size(value)
+        if size > self.max_bytes:
+            return False
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires_at, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+        return True
+
+    def get_or_load(self, key, loader, ttl=None):
+        hit, value = self.get(key)
+        if hit:
+            return value
+        value = loader()
+        self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, namespace=None):
+        with self._lock:
+            for key in [k for k in self._data if namespace is None or k[0] == namespace]:
+                self._remove(key)
+
+    def purge_expired(self):
+        # 다시 조회되지 않은 만료 항목은 LRU로 밀려날 때까지 남으므로 주기적으로 지운다
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, entry in self._data.items() if entry[0] < now]
+            for key in expired:
+                self._remove(key)
+        return len(expired)
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+# --- CACHE PETUNJUK PEMBUKA (첫 질문 힌트 캐시) ---
+# 한 반이 같은 학습지 문제를 첫 메시지로 붙여 넣는 경우가 많으므로, 첫 턴의 응답만
+# (정규화한 시스템 프롬프트, 정규화한 문제) 기준으로 재사용한다.
+# 수식 부분(숫자·기호·영문)이 완전히 같은 문제들 중에서만 문장 유사도로 근사 일치를 찾아,
+# 숫자 하나만 다른 다른 문제에 같은 힌트가 나가지 않도록 한다.
+
+_MATH_DELIMITERS = re.compile(r"\$\$?|\\[()\[\]]|\\left|\\right|\\displaystyle|\\[,;!]")
+_WHITESPACE = re.compile(r"\s+")
+_MATH_SIGNATURE = re.compile(r"[^0-9a-z+\-*/^=<>(){}\[\]|\\_]")
+
+
+def normalize_text(text):
+    # $, $$, \( \), \[ \] 구분자와 공백 차이를 없앤 비교용 문자열
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _MATH_DELIMITERS.sub("", text)
+    return _WHITESPACE.sub("", text)
+
+
+def math_signature(normalized):
+    # 한글 등 설명 문장을 빼고 남은 수식 문자열
+    return _MATH_SIGNATURE.sub("", normalized)
+
+
+def ngram_vector(normalized, n=3):
+    counts = {}
+    for i in range(max(1, len(normalized) - n + 1)):
+        gram = zlib.crc32(normalized[i:i + n].encode("utf-8"))
+        counts[gram] = counts.get(gram, 0) + 1
+    norm = math.sqrt(sum(c * c for c in counts.values())) or 1.0
+    return {gram: c / norm for gram, c in counts.items()}
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(gram, 0.0) for gram, value in a.items())
+
+
+class HintCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=86400.0, similarity=0.9, max_candidates=64):
+        self.similarity = similarity
+        self.max_candidates = max_candidates
+        # 캐시 값은 (힌트, n-gram 벡터): 벡터도 max_bytes에 포함되고, 항목이 만료·제거되면 색인에서도 빠진다
+        self._cache = TTLLRUCache(max_bytes=max_bytes, default_ttl=ttl, on_evict=self._forget_key)
+        # (프롬프트 해시, 수식 서명) -> [(캐시 키, n-gram 벡터)]. 벡터는 캐시 값과 같은 객체
+        self._index = {}
+        self._lock = threading.Lock()
+        # 만료 항목 정리 간격 (put 때 확인)
+        self.purge_interval = min(ttl, 600.0)
+        self._purged_at = time.monotonic()
+        self.exact_hits = 0
+        self.near_hits = 0
+
+    @staticmethod
+    def _prompt_hash(system_prompt, model):
+        return hashlib.sha256(f"{model}\0{normalize_text(system_prompt)}".encode("utf-8")).hexdigest()
+
+    def get(self, system_prompt, model, message):
+        prompt_hash = self._prompt_hash(system_prompt, model)
+        normalized = normalize_text(message)
+        key = ("hint", prompt_hash, normalized)
+        hit, value = self._cache.get(key)
+        if hit:
+            self.exact_hits += 1
+            return value[0], "exact"
+
+        bucket_key = (prompt_hash, math_signature(normalized))
+        with self._lock:
+            candidates = list(self._index.get(bucket_key, ()))
+        if candidates:
+            vector = ngram_vector(normalized)
+            best_score, best_key = max(((cosine(vector, v), k) for k, v in candidates), key=lambda c: c[0])
+            if best_score >= self.similarity:
+                hit, value = self._cache.get(best_key)
+                if hit:
+                    self.near_hits += 1
+                    return value[0], "near"
+                self._forget(bucket_key, best_key)
+        return None, "miss"
+
+    def put(self, system_prompt, model, message, answer):
+        prompt_hash = self._prompt_hash(system_prompt, model)
+        normalized = normalize_text(message)
+        key = ("hint", prompt_hash, normalized)
+        now = time.monotonic()
+        if now - self._purged_at > self.purge_interval:
+            self._purged_at = now
+            self._cache.purge_expired()
+        vector = ngram_vector(normalized)
+        if not self._cache.set(key, (answer, vector)):
+            return
+        bucket_key = (prompt_hash, math_signature(normalized))
+        with self._lock:
+            bucket = self._index.setdefault(bucket_key, [])
+            if all(k != key for k, _ in bucket):
+                bucket.append((key, vector))
+                # 같은 문제의 변형이 계속 쌓이지 않도록 오래된 것부터 버림
+                del bucket[:-self.max_candidates]
+
+    def _forget_key(self, key):
+        # TTLLRUCache.on_evict: 캐시 잠금 안에서 호출되므로 여기서 캐시를 다시 부르지 않는다
+        _, prompt_hash, normalized = key
+        self._forget((prompt_hash, math_signature(normalized)), key)
+
+    def _forget(self, bucket_key, key):
+        # 캐시에서 만료·제거된 항목은 색인에서도 지움
+        with self._lock:
+            bucket = self._index.get(bucket_key)
+            if bucket is None:
+                return
+            bucket[:] = [(k, v) for k, v in bucket if k != key]
+            if not bucket:
+                del self._index[bucket_key]
+
+    def stats(self):
+        with self._lock:
+            indexed = sum(len(bucket) for bucket in self._index.values())
+        return {**self._cache.stats(), "exact_hits": self.exact_hits, "near_hits": self.near_hits, "indexed": indexed}
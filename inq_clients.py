@@ -0,0 +1,165 @@
+import atexit
+import threading
+
+import streamlit as st
+
+# --- KLIEN BERSAMA (프로세스 전체 공유) ---
+# Streamlit은 rerun마다 스크립트를 처음부터 다시 실행하므로,
+# HTTP/OpenAI 클라이언트는 st.cache_resource로 한 번만 만들고 모든 세션이 공유한다.
+# openai/httpx/pymongo/sqlalchemy는 import 자체가 무거우므로 처음 필요한 팩토리 안에서 불러온다
+# (학번/이름만 입력하는 첫 화면에서는 어느 것도 로드하지 않음).
+
+_created_clients = []
+_created_lock = threading.Lock()
+
+
+def _secret(name, default):
+    return st.secrets.get(name, default)
+
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401  (httpx[http2] 설치 여부 확인)
+        return True
+    except ImportError:
+        return False
+
+
+@st.cache_resource(show_spinner=False)
+def get_http_client():
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=int(_secret("HTTP_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(_secret("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)),
+        keepalive_expiry=float(_secret("HTTP_KEEPALIVE_EXPIRY", 30.0)),
+    )
+    timeout = httpx.Timeout(
+        float(_secret("OPENAI_TIMEOUT", 60.0)),
+        connect=float(_secret("OPENAI_CONNECT_TIMEOUT", 5.0)),
+    )
+    # HTTP/2는 h2 패키지가 있을 때만 사용
+    http2 = bool(_secret("HTTP2", False)) and _http2_available()
+
+    # httpx.Client를 명시적으로 사용하여 환경 프록시 설정 충돌(TypeError) 방지
+    http_client = httpx.Client(limits=limits, timeout=timeout, http2=http2)
+    with _created_lock:
+        _created_clients.append(http_client)
+    return http_client
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    from openai import OpenAI
+
+    # OPENAI_BASE_URL: OpenAI 호환 서버(부하 테스트용 모의 서버 등)를 쓸 때 지정
+    base_url = _secret("OPENAI_BASE_URL", None)
+    try:
+        return OpenAI(
+            api_key=st.secrets["OPENAI_API_KEY"],
+            base_url=base_url,
+            http_client=get_http_client(),
+            max_retries=int(_secret("OPENAI_MAX_RETRIES", 2)),
+        )
+    except Exception:
+        # 예외 발생 시 표준 초기화로 대체
+        return OpenAI(api_key=st.secrets["OPENAI_API_KEY"], base_url=base_url)
+
+
+@st.cache_resource(show_spinner=False)
+def get_local_llm_client():
+    from openai import OpenAI
+
+    # LOCAL_LLM_BASE_URL: 인터넷 없는 교실용 OpenAI 호환 서버 (예: Ollama http://localhost:11434/v1)
+    return OpenAI(
+        api_key=_secret("LOCAL_LLM_API_KEY", "local"),
+        base_url=st.secrets["LOCAL_LLM_BASE_URL"],
+        http_client=get_http_client(),
+        max_retries=0,
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_mongo_client():
+    from pymongo import MongoClient as PyMongoClient
+
+    # 수업 종료 시 동시 저장이 몰려도 핸드셰이크가 반복되지 않도록 연결 풀을 재사용
+    mongo_client = PyMongoClient(
+        st.secrets["MONGO_URI"],
+        maxPoolSize=int(_secret("MONGO_MAX_POOL_SIZE", 20)),
+        minPoolSize=int(_secret("MONGO_MIN_POOL_SIZE", 0)),
+        maxIdleTimeMS=int(_secret("MONGO_MAX_IDLE_TIME_MS", 60000)),
+        waitQueueTimeoutMS=int(_secret("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)),
+        serverSelectionTimeoutMS=int(_secret("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+        connectTimeoutMS=int(_secret("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+        socketTimeoutMS=int(_secret("MONGO_SOCKET_TIMEOUT_MS", 20000)),
+        retryWrites=True,
+        retryReads=True,
+    )
+    with _created_lock:
+        _created_clients.append(mongo_client)
+    return mongo_client
+
+
+@st.cache_resource(show_spinner=False)
+def get_sql_engine(database_url):
+    from sqlalchemy import create_engine
+
+    # rerun마다 엔진(=연결 풀)을 새로 만들지 않도록 URL별로 한 번만 생성
+    connect_args = {}
+    statement_timeout_ms = int(_secret("DB_STATEMENT_TIMEOUT_MS", 10000))
+    if database_url.startswith(("postgresql", "postgres")):
+        # DB가 응답하지 않을 때 연결 시도에서 오래 멈추지 않도록 (statement_timeout과 무관하게 항상)
+        connect_args["connect_timeout"] = int(_secret("DB_CONNECT_TIMEOUT", 5))
+        if statement_timeout_ms > 0:
+            # 대시보드 쿼리가 오래 걸려 연결을 붙잡지 않도록 서버 측 제한
+            # (PgBouncer 트랜잭션 모드처럼 startup 옵션을 받지 않는 경우 0으로 끈다)
+            connect_args["options"] = f"-c statement_timeout={statement_timeout_ms}"
+    engine = create_engine(
+        database_url,
+        pool_size=int(_secret("DB_POOL_SIZE", 5)),
+        max_overflow=int(_secret("DB_MAX_OVERFLOW", 5)),
+        pool_timeout=float(_secret("DB_POOL_TIMEOUT", 10)),
+        # 호스팅 Postgres가 유휴 연결을 끊어도 죽은 연결을 쓰지 않도록
+        pool_pre_ping=True,
+        pool_recycle=int(_secret("DB_POOL_RECYCLE", 1800)),
+        connect_args=connect_args,
+    )
+    with _created_lock:
+        _created_clients.append(_EngineCloser(engine))
+    return engine
+
+
+def get_readonly_engine(database_url):
+    # 같은 연결 풀을 쓰면서 READ ONLY 트랜잭션으로 실행 (조회 전용 경로)
+    engine = get_sql_engine(database_url)
+    if engine.dialect.name == "postgresql":
+        return engine.execution_options(postgresql_readonly=True)
+    return engine
+
+
+class _EngineCloser:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def close(self):
+        self.engine.dispose()
+
+
+def close_clients():
+    # 서버 종료 시 keep-alive 연결과 DB 연결 풀을 정리
+    with _created_lock:
+        clients = list(_created_clients)
+        _created_clients.clear()
+    for created in clients:
+        try:
+            created.close()
+        except Exception:
+            pass
+    get_openai_client.clear()
+    get_http_client.clear()
+    get_mongo_client.clear()
+    get_sql_engine.clear()
+
+
+atexit.register(close_clients)
@@ -0,0 +1,64 @@
+import json
+import zlib
+
+# --- FORMAT TRANSKRIP (압축 저장 형식) ---
+# 대화 기록을 [역할 코드, 내용] 목록의 JSON으로 바꾼 뒤 압축하여 바이너리 한 덩어리로 저장한다.
+#   헤더: b"IQ" + 형식 버전(1바이트) + 압축 방식(1바이트)
+#   본문: [["u", "..."], ["a", "..."], ...] 를 zstd(설치된 경우) 또는 zlib(DEFLATE, gzip과 같은 알고리즘)로 압축
+#   zstd로 쓴 기록은 zstandard가 있어야 읽을 수 있으므로 requirements.txt에 고정해 두었다.
+# page_4 피드백(요약)은 별도 필드로 저장하므로, 목록·요약만 볼 때는 본문을 풀 필요가 없다.
+# FORMAT_LEGACY(0)는 기존의 {"role", "content"} JSON 목록 그대로의 형식.
+
+FORMAT_LEGACY = 0
+FORMAT_COMPACT_V1 = 1
+
+MAGIC = b"IQ"
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+ROLE_CODES = {"user": "u", "assistant": "a", "system": "s"}
+CODE_ROLES = {code: role for role, code in ROLE_CODES.items()}
+
+# 이보다 짧은 본문은 압축해도 헤더 때문에 오히려 커질 수 있어 그대로 둔다
+MIN_COMPRESS_BYTES = 256
+
+
+def _zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+def encode_transcript(messages, level=None):
+    rows = [[ROLE_CODES.get(m["role"], m["role"]), m["content"]] for m in messages]
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) < MIN_COMPRESS_BYTES:
+        return MAGIC + bytes([FORMAT_COMPACT_V1, CODEC_NONE]) + raw
+    zstandard = _zstd()
+    if zstandard is not None:
+        body = zstandard.ZstdCompressor(level=level or 10).compress(raw)
+        return MAGIC + bytes([FORMAT_COMPACT_V1, CODEC_ZSTD]) + body
+    body = zlib.compress(raw, level or 9)
+    return MAGIC + bytes([FORMAT_COMPACT_V1, CODEC_ZLIB]) + body
+
+
+def decode_transcript(blob):
+    blob = bytes(blob)
+    if blob[:2] != MAGIC:
+        raise ValueError("대화 기록 형식을 알 수 없습니다.")
+    version, codec, body = blob[2], blob[3], blob[4:]
+    if version != FORMAT_COMPACT_V1:
+        raise ValueError(f"지원하지 않는 대화 기록 형식 버전: {version}")
+    if codec == CODEC_ZSTD:
+        zstandard = _zstd()
+        if zstandard is None:
+            raise RuntimeError("zstd로 압축된 기록을 읽으려면 zstandard 패키지가 필요합니다.")
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif codec == CODEC_ZLIB:
+        body = zlib.decompress(body)
+    elif codec != CODEC_NONE:
+        raise ValueError(f"알 수 없는 압축 방식: {codec}")
+    return [{"role": CODE_ROLES.get(code, code), "content": content} for code, content in json.loads(body)]
@@ -0,0 +1,96 @@
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# --- PENGELOLAAN KONTEKS (토큰 예산 기반 대화 기록 구성) ---
+# 긴 대화에서도 시스템 프롬프트와 문제(첫 학생 메시지)는 항상 유지하고,
+# 예산을 넘는 오래된 대화는 누적 요약(rolling summary) 하나로 대체한다.
+
+# 메시지마다 role/구분자 등으로 붙는 토큰 수 (OpenAI 채팅 포맷 기준 근사치)
+MESSAGE_OVERHEAD_TOKENS = 4
+# 요약 후에는 예산의 이 비율까지만 채워, 매 턴마다 요약 호출이 반복되지 않도록 함
+SUMMARY_TARGET_RATIO = 0.7
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    # 인코딩 파일 로드가 무거우므로 처음 토큰을 셀 때 한 번만 불러옴
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:  # tiktoken이 없거나 인코딩을 받을 수 없으면 근사치 사용
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text):
+    # 같은 메시지는 한 번만 계산하고 캐시된 값을 재사용
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 한글은 대략 글자당 1토큰(UTF-8 3바이트), 영문/수식은 더 적으므로 보수적인 추정
+    return max(1, len(text.encode("utf-8")) // 3)
+
+
+def message_tokens(message):
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def new_summary_state():
+    # upto: 요약에 반영된 messages의 끝 인덱스 (messages[1:upto]가 요약됨)
+    return {"summary": "", "upto": 1}
+
+
+def build_history(system_prompt, messages, prompt, state, budget, reserve, summarize):
+    """API에 보낼 메시지 목록을 예산 안에서 구성한다.
+
+    messages[0]은 학생이 처음 제시한 문제로 간주하여 항상 유지한다.
+    summarize(previous_summary, messages_to_fold)는 새 요약 문자열을 반환해야 한다.
+    """
+    head = [{"role": "system", "content": system_prompt}]
+    if messages:
+        head.append(messages[0])
+    tail = [{"role": "user", "content": prompt}]
+
+    fixed = sum(message_tokens(m) for m in head + tail) + reserve
+    available = budget - fixed
+
+    # 요약 이후의 메시지들 중 최근 것부터 예산 안에 들어가는 만큼 유지
+    start = max(state["upto"], 1)
+    used = count_tokens(state["summary"]) + MESSAGE_OVERHEAD_TOKENS if state["summary"] else 0
+    history_tokens = sum(message_tokens(m) for m in messages[start:])
+
+    if used + history_tokens > available and len(messages) > start:
+        target = available * SUMMARY_TARGET_RATIO
+        cut = len(messages)
+        kept = 0
+        while cut > start and kept + message_tokens(messages[cut - 1]) <= target:
+            cut -= 1
+            kept += message_tokens(messages[cut])
+        # user/assistant 쌍이 갈라지지 않도록 user 메시지에서 시작
+        while cut < len(messages) and messages[cut]["role"] != "user":
+            cut += 1
+
+        folded = messages[start:cut]
+        if folded:
+            logger.info(
+                "컨텍스트 예산 초과 (%d/%d 토큰): 메시지 %d-%d를 요약으로 대체합니다.",
+                fixed + used + history_tokens, budget, start, cut - 1,
+            )
+            try:
+                state["summary"] = summarize(state["summary"], folded)
+                state["upto"] = cut
+                start = cut
+            except Exception as e:
+                # 요약에 실패하면 오래된 메시지를 잘라내기만 함
+                logger.warning("대화 요약에 실패하여 오래된 메시지를 생략합니다: %s", e)
+                start = cut
+
+    body = []
+    if state["summary"]:
+        body.append({"role": "system", "content": f"지금까지의 대화 요약:\n{state['summary']}"})
+    body.extend(messages[start:])
+    return head + body + tail
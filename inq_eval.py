@@ -1,12 +1,61 @@
+import os
+import tempfile
+from datetime import datetime
+
 import streamlit as st
-import json
-from sqlalchemy import create_engine, text
+from inq_cache import TTLLRUCache
+from inq_export import EXPORT_FORMATS, aggregate_stats, write_export
+from inq_storage import get_storage
+from inq_metrics import init_tracing, span, load_events, summarize_spans, summarize_usage
+
+# -----------------------------
+# 저장소 연결 (Supabase / Railway secrets)
+# -----------------------------
+# 학생 앱과 같은 저장소 백엔드(inq_storage)를 읽는다. STORAGE_BACKEND가 없으면 DATABASE_URL의 PostgreSQL.
+# 비밀번호 입력 화면에서는 드라이버를 불러오지도, 연결하지도 않도록 처음 조회할 때 만든다
+
+# 조회 지연 시간 기록 (TRACING_ENABLED). 학생 앱과 같은 METRICS_LOG_PATH를 읽어 관리자 화면에 집계
+init_tracing()
+METRICS_LOG_PATH = st.secrets.get("METRICS_LOG_PATH", "inq_metrics.jsonl")
+
+# 한 페이지에 보여줄 레코드 수
+PAGE_SIZE = int(st.secrets.get("EVAL_PAGE_SIZE", 50))
+# 내보내기/통계에서 서버 측 커서로 한 번에 읽는 대화 기록 수
+EXPORT_BATCH_SIZE = int(st.secrets.get("EVAL_EXPORT_BATCH_SIZE", 500))
+
+# -----------------------------
+# 목록 조회용 테이블/인덱스 (프로세스 시작 시 한 번만 생성)
+# -----------------------------
+@st.cache_resource(show_spinner=False)
+def ensure_indexes():
+    try:
+        get_storage().ensure_schema()
+    except Exception as e:
+        # 권한이 없는 계정이어도 조회는 가능하도록 경고만 표시
+        st.warning(f"인덱스 생성에 실패했습니다: {e}")
+    return True
 
 # -----------------------------
-# PostgreSQL 연결 (Supabase / Railway secrets)
+# 조회 결과 캐시 (모든 교사 세션이 공유)
 # -----------------------------
-DATABASE_URL = st.secrets["DATABASE_URL"]
-engine = create_engine(DATABASE_URL)
+# 목록은 새 대화가 저장되면 바뀌므로 짧게, 개별 대화 기록은 바뀌지 않으므로 길게 보관
+RECORDS_TTL = float(st.secrets.get("EVAL_RECORDS_CACHE_TTL", 30))
+CHAT_TTL = float(st.secrets.get("EVAL_CHAT_CACHE_TTL", 3600))
+# 새 레코드 확인(max(id), max(time))은 이 간격마다 한 번만 실행
+WATERMARK_TTL = float(st.secrets.get("EVAL_WATERMARK_TTL", 5))
+
+@st.cache_resource(show_spinner=False)
+def get_query_cache():
+    return TTLLRUCache(
+        max_bytes=int(st.secrets.get("EVAL_CACHE_MAX_MB", 64)) * 1024 * 1024,
+        default_ttl=RECORDS_TTL,
+    )
+
+def invalidate_records_cache():
+    # 새 대화가 저장된 뒤 목록을 즉시 갱신해야 할 때 호출
+    cache = get_query_cache()
+    cache.invalidate("watermark")
+    cache.invalidate("records")
 
 # -----------------------------
 # Streamlit 앱 설정
@@ -20,53 +69,180 @@ st.title("학생의 인공지능 사용 내역 (교사용)")
 password = st.text_input("비밀번호를 입력하세요", type="password")
 
 # -----------------------------
-# PostgreSQL에서 모든 레코드 가져오기
+# 저장소에서 레코드 한 페이지 가져오기 (키셋 페이지네이션)
 # -----------------------------
-def fetch_records():
+def _query_records(cursor, number, name, date_from, date_to, limit):
+    # cursor: 이전 페이지 마지막 행의 (time, id). 그보다 오래된 행부터 limit개를 가져온다
+    with span("db.query", query="records"):
+        return get_storage().list_records(cursor, number, name, date_from, date_to, limit)
+
+def _query_watermark():
+    # 기본키/시간 인덱스만 읽는 가벼운 쿼리. 값이 바뀌면 목록 캐시 키도 바뀐다
+    with span("db.query", query="watermark"):
+        return get_storage().watermark()
+
+def fetch_records(cursor=None, number="", name="", date_from=None, date_to=None, limit=PAGE_SIZE):
+    cache = get_query_cache()
     try:
-        with engine.connect() as conn:
-            result = conn.execute(
-                text("SELECT id, number, name, time FROM qna ORDER BY time DESC")
-            )
-            records = [{"id": row.id, "number": row.number, "name": row.name, "time": row.time} for row in result]
-        return records
+        watermark = cache.get_or_load(("watermark",), _query_watermark, ttl=WATERMARK_TTL)
+        key = ("records", watermark, cursor, number, name, date_from, date_to, limit)
+        return cache.get_or_load(
+            key, lambda: _query_records(cursor, number, name, date_from, date_to, limit), ttl=RECORDS_TTL
+        )
     except Exception as e:
-        st.error(f"PostgreSQL 오류: {e}")
-        return []
+        st.error(f"데이터베이스 오류: {e}")
+        return [], False
 
 # -----------------------------
 # 특정 ID의 레코드 가져오기
 # -----------------------------
+def _query_record_by_id(record_id):
+    with span("db.query", query="chat"):
+        return get_storage().get_chat(record_id)
+
 def fetch_record_by_id(record_id):
+    # 파싱된 대화 기록을 캐시하여 선택을 바꿀 때마다 다시 조회·파싱하지 않음
     try:
-        with engine.connect() as conn:
-            result = conn.execute(
-                text("SELECT chat FROM qna WHERE id = :id"), {"id": record_id}
-            )
-            row = result.fetchone()
-            if row and row.chat:
-                chat_data = row.chat
-                # chat가 문자열이면 json으로 변환
-                if isinstance(chat_data, str):
-                    chat_data = json.loads(chat_data)
-                return chat_data
-            return None
+        return get_query_cache().get_or_load(("chat", record_id), lambda: _query_record_by_id(record_id), ttl=CHAT_TTL)
+    except Exception as e:
+        st.error(f"데이터베이스 오류: {e}")
+        return None
+
+def _query_summary_by_id(record_id):
+    with span("db.query", query="summary"):
+        return get_storage().get_summary(record_id)
+
+def fetch_summary_by_id(record_id):
+    # 요약(page_4 피드백)만 읽음. 예전 형식의 기록은 대화 기록 마지막에 요약이 들어 있어 None
+    try:
+        return get_query_cache().get_or_load(("summary", record_id), lambda: _query_summary_by_id(record_id), ttl=CHAT_TTL)
+    except Exception as e:
+        st.error(f"데이터베이스 오류: {e}")
+        return None
+
+# -----------------------------
+# 학급 통계 및 내보내기 (검색 조건에 맞는 전체 기록)
+# -----------------------------
+def _transcript_batches(number, name, date_from, date_to):
+    return get_storage().iter_transcript_batches(number, name, date_from, date_to, batch_size=EXPORT_BATCH_SIZE)
+
+def fetch_class_stats(number, name, date_from, date_to):
+    # 통계는 새 기록이 저장될 때만 바뀌므로 watermark를 키에 넣어 캐시
+    cache = get_query_cache()
+    try:
+        watermark = cache.get_or_load(("watermark",), _query_watermark, ttl=WATERMARK_TTL)
+        def load():
+            with span("db.query", query="stats"):
+                return aggregate_stats(_transcript_batches(number, name, date_from, date_to))
+        return cache.get_or_load(("records", "stats", watermark, number, name, date_from, date_to), load, ttl=RECORDS_TTL)
     except Exception as e:
-        st.error(f"PostgreSQL 오류: {e}")
+        st.error(f"데이터베이스 오류: {e}")
         return None
 
+EXPORT_PREFIX = "inq_export_"
+EXPORT_STALE_SECONDS = 3600
+
+def export_transcripts(fmt, number, name, date_from, date_to):
+    # 임시 파일에 batch 단위로 기록한 뒤 내용을 읽어 (건수, bytes)를 반환. 파일은 바로 지움
+    suffix = EXPORT_FORMATS[fmt][1]
+    with tempfile.NamedTemporaryFile(prefix=EXPORT_PREFIX, suffix=suffix, delete=False) as f:
+        path = f.name
+        try:
+            with span("db.query", query="export", format=fmt):
+                count = write_export(_transcript_batches(number, name, date_from, date_to), fmt, f)
+        except Exception:
+            f.close()
+            os.remove(path)
+            raise
+    try:
+        with open(path, "rb") as f:
+            return count, f.read()
+    finally:
+        os.remove(path)
+
+@st.cache_resource(show_spinner=False)
+def cleanup_stale_exports():
+    # 프로세스가 내보내기 도중 종료되어 남은 임시 파일을 시작 시 한 번 정리
+    directory = tempfile.gettempdir()
+    now = datetime.now().timestamp()
+    for entry in os.scandir(directory):
+        if not entry.name.startswith(EXPORT_PREFIX):
+            continue
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > EXPORT_STALE_SECONDS:
+                os.remove(entry.path)
+        except OSError:
+            pass
+    return True
+
+cleanup_stale_exports()
+
+# -----------------------------
+# 답 노출 의심 턴 (학생 앱의 inq_guard가 기록)
+# -----------------------------
+def fetch_flags(number, name, date_from, date_to):
+    cache = get_query_cache()
+    try:
+        watermark = cache.get_or_load(("watermark",), _query_watermark, ttl=WATERMARK_TTL)
+        def load():
+            with span("db.query", query="flags"):
+                return get_storage().list_flags(number, name, date_from, date_to)
+        # 판정은 응답보다 늦게 기록되므로 목록과 같은 짧은 TTL로 보관
+        return cache.get_or_load(("records", "flags", watermark, number, name, date_from, date_to), load, ttl=RECORDS_TTL)
+    except Exception as e:
+        st.error(f"데이터베이스 오류: {e}")
+        return []
+
 # -----------------------------
 # 비밀번호 검증 및 레코드 표시
 # -----------------------------
 if password == st.secrets["PASSWORD"]:
-    records = fetch_records()
+    ensure_indexes()
+
+    # 검색 조건 (서버에서 필터링)
+    col_number, col_name, col_date = st.columns([1, 1, 2])
+    with col_number:
+        number_filter = st.text_input("학번 검색").strip()
+    with col_name:
+        name_filter = st.text_input("이름 검색").strip()
+    with col_date:
+        date_range = st.date_input("기간", value=())
+    date_from = date_range[0] if len(date_range) > 0 else None
+    date_to = date_range[1] if len(date_range) > 1 else date_from
+
+    # 검색 조건이 바뀌면 첫 페이지부터 다시 조회
+    filters = (number_filter, name_filter, date_from, date_to)
+    if st.session_state.get("record_filters") != filters:
+        st.session_state["record_filters"] = filters
+        st.session_state["record_cursors"] = [None]
+
+    cursors = st.session_state["record_cursors"]
+    records, has_next = fetch_records(cursors[-1], number_filter, name_filter, date_from, date_to)
 
     if records:
-        record_options = [
-            f"{rec['number']} ({rec['name']}) - {rec['time']}" for rec in records
-        ]
-        selected_record = st.selectbox("내역을 선택하세요:", record_options)
-        selected_record_id = records[record_options.index(selected_record)]["id"]
+        # id -> 레코드 사전으로 선택 항목을 O(1)에 찾음
+        records_by_id = {rec["id"]: rec for rec in records}
+        selected_record_id = st.selectbox(
+            f"내역을 선택하세요 ({len(cursors)} 페이지):",
+            list(records_by_id),
+            format_func=lambda rec_id: f"{records_by_id[rec_id]['number']} ({records_by_id[rec_id]['name']}) - {records_by_id[rec_id]['time']}",
+        )
+
+        col_prev, col_next = st.columns([1, 1])
+        with col_prev:
+            if st.button("이전 페이지", disabled=len(cursors) == 1):
+                cursors.pop()
+                st.rerun()
+        with col_next:
+            if st.button("다음 페이지", disabled=not has_next):
+                last = records[-1]
+                cursors.append((last["time"], last["id"]))
+                st.rerun()
+
+        summary = fetch_summary_by_id(selected_record_id)
+        if summary:
+            st.write("### 탐구 계획 피드백")
+            st.markdown(summary)
 
         chat = fetch_record_by_id(selected_record_id)
         if chat:
@@ -80,6 +256,129 @@ if password == st.secrets["PASSWORD"]:
             st.warning("선택된 레코드에 대화 기록이 없습니다.")
     else:
         st.warning("데이터베이스에 저장된 내역이 없습니다.")
+
+    # 튜터 응답이 정답·풀이를 알려 준 것으로 의심되는 턴 (규칙 + 모델 판정)
+    with st.expander("🚩 답 노출 의심 응답"):
+        # 학생 앱이 판정을 다른 백엔드에 쓰고 있으면 여기에 나타나지 않음 (학생 앱이 메트릭 로그에 남긴 값)
+        storage_events = load_events(METRICS_LOG_PATH, event_type="storage", limit=1000)
+        if storage_events and storage_events[-1].get("flags_backend") != get_storage().name:
+            st.warning(
+                f"학생 앱은 답 노출 판정을 '{storage_events[-1].get('flags_backend')}' 저장소에 기록하고 있어 "
+                f"이 앱('{get_storage().name}')에서는 보이지 않습니다. 두 앱의 STORAGE_BACKEND를 같게 하거나 "
+                f"학생 앱에 FLAGS_STORAGE_BACKEND='{get_storage().name}'를 설정하세요."
+            )
+        flags = fetch_flags(number_filter, name_filter, date_from, date_to)
+        if not st.checkbox("모델이 문제없다고 판정한 항목도 보기"):
+            flags = [flag for flag in flags if flag["verdict"] != "ok"]
+        if flags:
+            st.dataframe(
+                [
+                    {"time": f["time"], "number": f["number"], "name": f["name"], "turn": f["turn"],
+                     "verdict": f["verdict"], "rules": ", ".join(f["rules"]), "excerpt": f["excerpt"],
+                     "prompt": f["prompt"], "reason": f["reason"], "model": f["model"]}
+                    for f in flags
+                ],
+                use_container_width=True,
+            )
+        else:
+            st.write("기록된 항목이 없습니다.")
+
+    # 검색 조건에 맞는 전체 기록의 학급 통계와 파일 내보내기
+    with st.expander("📊 학급 통계 및 내보내기"):
+        st.caption("위의 학번·이름·기간 조건에 맞는 전체 대화 기록을 대상으로 합니다.")
+        if st.button("통계 계산"):
+            st.session_state["class_stats_filters"] = filters
+        if st.session_state.get("class_stats_filters") == filters:
+            result = fetch_class_stats(number_filter, name_filter, date_from, date_to)
+            if result is not None and result[2]:
+                stats, students, summary = result
+                col_a, col_b, col_c, col_d = st.columns(4)
+                col_a.metric("대화 기록", summary["transcripts"])
+                col_b.metric("평균 질문 수", f"{summary['turns_mean']:.1f}")
+                col_c.metric("마침까지 (중앙값, 분)", f"{summary['minutes_to_finish_median']:.1f}")
+                col_d.metric("답 노출 의심 응답", f"{summary['leak_turns']} ({summary['leak_rate']:.1%})")
+                st.write("#### 학생별")
+                st.dataframe(students, use_container_width=True)
+                st.write("#### 답 노출 의심 대화")
+                st.dataframe(stats[stats["leak_turns"] > 0], use_container_width=True)
+            elif result is not None:
+                st.write("조건에 맞는 대화 기록이 없습니다.")
+
+        export_format = st.radio("내보내기 형식", list(EXPORT_FORMATS), horizontal=True)
+        # 다운로드 버튼은 파일을 만든 직후 실행에서만 그린다. 세션 상태에 두면 다시 실행될 때마다
+        # 파일 전체가 미디어 저장소에 다시 올라가므로, 다시 받으려면 파일을 새로 만든다
+        if st.button("내보내기 파일 만들기"):
+            try:
+                count, data = export_transcripts(export_format, number_filter, name_filter, date_from, date_to)
+            except Exception as e:
+                st.error(f"내보내기 중 오류가 발생했습니다: {e}")
+            else:
+                mime, suffix = EXPORT_FORMATS[export_format]
+                st.download_button(
+                    f"다운로드 ({count}건, {export_format})", data,
+                    file_name=f"inq_transcripts_{datetime.now():%Y%m%d_%H%M}{suffix}", mime=mime,
+                )
+
+    # 캐시 상태 확인 및 수동 무효화
+    with st.expander("🔧 디버그: 조회 캐시"):
+        st.json(get_query_cache().stats())
+        if st.button("목록 새로고침"):
+            invalidate_records_cache()
+            st.rerun()
+
+    # 단계별 지연 시간 (학생 앱과 교사 앱이 기록한 span 집계)
+    with st.expander("⏱️ 관리자: 단계별 지연 시간"):
+        spans = load_events(METRICS_LOG_PATH, event_type="span")
+        if spans:
+            group_by = ("name",)
+            if st.checkbox("단계(step)별로 나누어 보기"):
+                group_by = ("name", "step")
+            st.caption(f"최근 span {len(spans)}개 ({METRICS_LOG_PATH})")
+            st.dataframe(summarize_spans(spans, group_by), use_container_width=True)
+            session_id = st.text_input("세션 ID로 추적").strip()
+            if session_id:
+                st.dataframe(
+                    [event for event in spans if event.get("session_id") == session_id],
+                    use_container_width=True,
+                )
+        else:
+            st.write("기록된 span이 없습니다. secrets에서 TRACING_ENABLED를 켜 주세요.")
+
+        # 모델 라우팅 정책 조정용: 호출 종류·모델별 비용과 응답 완료까지의 지연 시간 (TRACING_ENABLED와 무관하게 기록)
+        usage_events = load_events(METRICS_LOG_PATH, event_type="usage")
+        if usage_events:
+            st.write("#### 모델별 비용·지연 시간")
+            st.dataframe(summarize_usage(usage_events, ("call", "model")), use_container_width=True)
+            st.write("#### 세션별 비용·프롬프트 캐시 적중률")
+            st.dataframe(summarize_usage(usage_events, ("session_id",)), use_container_width=True)
+
+        # 학생 앱 게이트웨이의 동시 요청·재시도·대기 초과와 라우터의 대체 모델 전환 횟수 (누계)
+        llm_snapshots = load_events(METRICS_LOG_PATH, event_type="llm", limit=5000)
+        if llm_snapshots:
+            latest = llm_snapshots[-1]
+            st.write("#### LLM 게이트웨이 상태")
+            st.caption(f"{datetime.fromtimestamp(latest['ts']):%H:%M:%S} 기준, 대체 모델 전환 {latest['fallbacks']}회")
+            st.dataframe(
+                [{"gateway": kind, **stats} for kind, stats in latest["gateways"].items()],
+                use_container_width=True,
+            )
+
+    # 학생 앱 세션 수와 세션 상태 메모리 (inq_session 정리 스레드가 주기적으로 기록)
+    with st.expander("🧠 관리자: 학생 세션 메모리"):
+        snapshots = load_events(METRICS_LOG_PATH, event_type="sessions", limit=5000)
+        if snapshots:
+            latest = snapshots[-1]
+            col_s, col_m, col_o, col_b = st.columns(4)
+            col_s.metric("세션", latest["sessions"])
+            col_m.metric("메모리에 있는 세션", latest["in_memory"])
+            col_o.metric("디스크로 옮긴 세션", latest["offloaded_sessions"])
+            col_b.metric("세션 상태 합계", f"{latest['bytes'] / 1024 / 1024:.1f} MB")
+            st.line_chart(
+                {"세션": [e["sessions"] for e in snapshots], "메모리 (KB)": [e["bytes"] / 1024 for e in snapshots]}
+            )
+            st.json(latest)
+        else:
+            st.write("기록된 세션 정보가 없습니다.")
 else:
     if password:  # 비어있을 때는 에러 안뜨게
         st.error("비밀번호가 틀렸습니다.")
@@ -0,0 +1,143 @@
+import csv
+import io
+import json
+
+from inq_guard import LEAK_PATTERN
+
+# --- EKSPOR & STATISTIK KELAS (교사용) ---
+# 저장소의 iter_transcript_batches로 대화 기록을 batch 단위로 읽어
+#   - 파일로 내보내기: CSV/Parquet은 메시지 한 건당 한 행, JSONL은 대화 기록 한 건당 한 줄
+#   - 학급 통계: batch마다 pandas로 벡터 연산하여 대화 한 건당 한 행의 요약만 남김 (본문은 버림)
+# 어느 쪽도 전체 대화 본문을 한꺼번에 메모리에 올리지 않는다.
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "jsonl": ("application/jsonl", ".jsonl"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+MESSAGE_COLUMNS = ["id", "number", "name", "time", "index", "role", "content"]
+
+# 튜터가 답을 거의 알려준 것으로 의심되는 응답: 학생 앱의 사전 검사(inq_guard)와 같은 규칙
+ANSWER_LEAK_PATTERN = LEAK_PATTERN
+
+
+def _message_rows(batch):
+    # 요약(page_4 피드백)은 role "summary"인 마지막 행으로 붙인다
+    for record in batch:
+        messages = record["chat"]
+        if record.get("summary"):
+            messages = messages + [{"role": "summary", "content": record["summary"]}]
+        for index, message in enumerate(messages):
+            yield (str(record["id"]), record["number"], record["name"], record["time"],
+                   index, message.get("role"), message.get("content"))
+
+
+def _json_default(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def write_export(batches, fmt, f):
+    # f: 바이너리 모드로 연 파일. 내보낸 대화 기록 수를 반환
+    count = 0
+    if fmt == "csv":
+        # 엑셀에서 한글이 깨지지 않도록 BOM 포함
+        text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+        writer = csv.writer(text)
+        writer.writerow(MESSAGE_COLUMNS)
+        for batch in batches:
+            writer.writerows(_message_rows(batch))
+            count += len(batch)
+        text.flush()
+        text.detach()
+    elif fmt == "jsonl":
+        for batch in batches:
+            for record in batch:
+                line = json.dumps({**record, "id": str(record["id"])}, ensure_ascii=False, default=_json_default)
+                f.write(line.encode("utf-8") + b"\n")
+            count += len(batch)
+    elif fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([
+            ("id", pa.string()), ("number", pa.string()), ("name", pa.string()), ("time", pa.timestamp("us")),
+            ("index", pa.int32()), ("role", pa.string()), ("content", pa.string()),
+        ])
+        with pq.ParquetWriter(f, schema, compression="zstd") as writer:
+            for batch in batches:
+                columns = list(zip(*_message_rows(batch))) or [()] * len(MESSAGE_COLUMNS)
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema,
+                ))
+                count += len(batch)
+    else:
+        raise ValueError(f"지원하지 않는 내보내기 형식: {fmt}")
+    return count
+
+
+def transcript_stats(batch):
+    # 대화 기록 batch -> 대화 한 건당 한 행의 통계 DataFrame
+    import pandas as pd
+
+    records = pd.DataFrame(
+        [{k: r[k] for k in ("id", "number", "name", "time", "started", "finished", "turns")} for r in batch],
+        columns=["id", "number", "name", "time", "started", "finished", "turns"],
+    )
+    messages = pd.DataFrame(
+        [(r["id"], m.get("role"), m.get("content") or "") for r in batch for m in r["chat"]],
+        columns=["id", "role", "content"],
+    )
+    is_user = messages["role"] == "user"
+    is_assistant = messages["role"] == "assistant"
+    # 정규식은 튜터 응답에만 적용
+    leaks = messages.loc[is_assistant, "content"].str.contains(ANSWER_LEAK_PATTERN)
+    per_record = pd.DataFrame({
+        "id": messages["id"],
+        "user_turns": is_user,
+        "assistant_turns": is_assistant,
+        "user_chars": messages["content"].str.len().where(is_user, 0),
+        "leak_turns": leaks.reindex(messages.index, fill_value=False),
+    }).groupby("id", sort=False).sum()
+
+    stats = records.merge(per_record, left_on="id", right_index=True, how="left")
+    counts = ["user_turns", "assistant_turns", "user_chars", "leak_turns"]
+    stats[counts] = stats[counts].fillna(0).astype("int64")
+    # 예전 형식의 기록에는 turns가 없으므로 대화 본문에서 센 값을 사용
+    stats["turns"] = stats["turns"].astype("float64").fillna(stats["user_turns"]).astype("int64")
+    # [마침] 시각이 없으면 저장 시각을 끝으로 본다
+    end = pd.to_datetime(stats["finished"]).fillna(pd.to_datetime(stats["time"]))
+    stats["minutes_to_finish"] = (end - pd.to_datetime(stats["started"])).dt.total_seconds() / 60
+    return stats.drop(columns=["finished"])
+
+
+def aggregate_stats(batches):
+    # 반환값: (대화별 통계, 학생별 통계, 학급 요약)
+    import pandas as pd
+
+    frames = [transcript_stats(batch) for batch in batches]
+    if not frames:
+        return pd.DataFrame(), pd.DataFrame(), {}
+    stats = pd.concat(frames, ignore_index=True)
+
+    students = stats.groupby(["number", "name"], sort=True).agg(
+        sessions=("id", "size"),
+        turns_total=("turns", "sum"),
+        turns_mean=("turns", "mean"),
+        minutes_to_finish_median=("minutes_to_finish", "median"),
+        assistant_turns=("assistant_turns", "sum"),
+        leak_turns=("leak_turns", "sum"),
+    )
+    students["leak_rate"] = students["leak_turns"] / students["assistant_turns"].where(students["assistant_turns"] > 0)
+    students = students.drop(columns=["assistant_turns"]).reset_index()
+
+    assistant_turns = int(stats["assistant_turns"].sum())
+    summary = {
+        "transcripts": len(stats),
+        "students": len(students),
+        "turns_mean": float(stats["turns"].mean()),
+        "minutes_to_finish_median": float(stats["minutes_to_finish"].median()),
+        "leak_turns": int(stats["leak_turns"].sum()),
+        "leak_rate": float(stats["leak_turns"].sum() / assistant_turns) if assistant_turns else 0.0,
+        "transcripts_with_leak": int((stats["leak_turns"] > 0).sum()),
+    }
+    return stats, students, summary
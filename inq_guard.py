@@ -0,0 +1,112 @@
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# --- PENJAGA JAWABAN (정답 노출 검사) ---
+# 시스템 프롬프트는 정답·풀이 제공을 금지하지만 응답을 확인하는 단계가 없었다.
+# 1) 사전 검사: 정규식 규칙으로 완성된 풀이 형태를 찾는다. 스트리밍 중 새로 받은 부분만
+#    다시 검사하므로 청크당 수 마이크로초이며, 턴 지연 시간에 영향을 주지 않는다.
+# 2) 모델 검사: 규칙에 걸리면 그 즉시 백그라운드에서 작은 모델에 판정을 맡긴다
+#    (스트리밍 출력과 동시에 진행, 학생 화면은 기다리지 않음).
+# 3) 규칙에 걸린 턴은 판정 결과와 함께 저장소(guard_flags)에 기록되어 교사 화면에서 확인한다.
+
+# (이름, 정규식): 이름은 교사 화면과 기록에 그대로 남는다
+RULES = [
+    # $$ x = 3 $$, $x=\frac{1}{2}$ 처럼 변수 하나에 값을 대입한 최종 결과
+    ("final_equation", r"\$\$?\s*[a-z]\s*=\s*[-+]?\s*(?:\d|\\frac|\\sqrt|\\pm)[^$]{0,40}\$"),
+    # "정답은 5", "답은 x = 2", "해는 ... = ..."
+    ("answer_phrase", r"(?:정답은|답은|해는)\s*(?:[^\n.]{0,20}?=|\$?\s*[-+]?\d)"),
+    # x = 2 또는 x = 3 처럼 두 근을 모두 제시
+    ("root_pair", r"\b[a-z]\s*=\s*-?\d+(?:\.\d+)?\s*(?:또는|이고|,|\\text\{\s*또는\s*\})\s*\$?\s*[a-z]\s*=\s*-?\d"),
+    # \boxed{...}: 최종 답을 강조하는 표기
+    ("boxed", r"\\boxed\{"),
+]
+PATTERNS = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in RULES]
+# 통계(inq_export)처럼 규칙 이름 없이 해당 여부만 필요할 때
+LEAK_PATTERN = re.compile("|".join(f"(?:{pattern})" for _, pattern in RULES), re.IGNORECASE)
+
+# 규칙 하나가 걸칠 수 있는 최대 길이. 스트리밍 중에는 이만큼 겹쳐서 새 부분만 검사
+OVERLAP_CHARS = 120
+EXCERPT_CHARS = 80
+
+
+def prescreen(text):
+    # 반환값: [(규칙 이름, 일치한 위치)] (걸린 규칙이 없으면 빈 목록)
+    hits = []
+    for name, pattern in PATTERNS:
+        match = pattern.search(text)
+        if match:
+            hits.append((name, match.start()))
+    return hits
+
+
+def excerpt(text, position):
+    start = max(0, position - EXCERPT_CHARS // 2)
+    return text[start:start + EXCERPT_CHARS]
+
+
+class TurnGuard:
+    """한 턴의 응답을 검사한다. on_flag(rules, text, position)는 처음 걸렸을 때 한 번만 호출된다."""
+
+    __slots__ = ("on_flag", "text", "scanned", "rules", "flagged")
+
+    def __init__(self, on_flag):
+        self.on_flag = on_flag
+        self.text = ""
+        self.scanned = 0
+        self.rules = []
+        self.flagged = False
+
+    def feed(self, delta):
+        # 스트리밍 청크마다 호출: 마지막 검사 위치에서 OVERLAP_CHARS 앞부터만 다시 검사
+        self.text += delta
+        if self.flagged or len(self.text) - self.scanned < 16:
+            return
+        start = max(0, self.scanned - OVERLAP_CHARS)
+        self._check(self.text[start:], start)
+        self.scanned = len(self.text)
+
+    def finish(self, text=None):
+        # 응답이 끝나면 전체를 한 번 더 검사 (스트리밍이 아닌 경로는 여기서만 검사)
+        if text is not None:
+            self.text = text
+        if not self.flagged:
+            self._check(self.text, 0)
+        return self.rules
+
+    def _check(self, window, offset):
+        hits = prescreen(window)
+        if hits:
+            self.rules = [name for name, _ in hits]
+            self.flagged = True
+            self.on_flag(self.rules, self.text, offset + min(position for _, position in hits))
+
+
+# --- Pemeriksaan model (모델 판정) ---
+JUDGE_PROMPT = """
+너는 수학 튜터 챗봇의 응답을 검사하는 역할이다. 튜터는 학생에게 정답이나 풀이 과정을 직접 알려 주면 안 된다.
+학생의 문제와 튜터의 응답을 보고, 응답이 최종 답 또는 답을 그대로 얻을 수 있는 완성된 풀이를 알려 주는지 판정하라.
+개념, 공식, 접근 방법, 유도 질문만 제시한 경우는 노출이 아니다.
+반드시 JSON 한 줄로만 답하라: {"leak": true 또는 false, "reason": "한 문장 이유"}
+""".strip()
+
+
+def parse_verdict(content):
+    # JSON 모드를 지원하지 않는 로컬 서버도 있으므로 본문에서 첫 JSON 객체를 찾아 읽는다
+    match = re.search(r"\{.*\}", content or "", re.DOTALL)
+    if match:
+        try:
+            data = json.loads(match.group(0))
+            return ("leak" if data.get("leak") else "ok"), str(data.get("reason", ""))
+        except ValueError:
+            pass
+    return "unknown", (content or "")[:200]
+
+
+def judge_messages(problem, prompt, answer):
+    return [
+        {"role": "system", "content": JUDGE_PROMPT},
+        {"role": "user", "content": f"[학생의 문제]\n{problem}\n\n[학생의 이번 질문]\n{prompt}\n\n[튜터의 응답]\n{answer}"},
+    ]
@@ -0,0 +1,440 @@
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import streamlit as st
+
+from inq_clients import get_local_llm_client, get_openai_client
+from inq_metrics import get_metrics_sink, span
+
+logger = logging.getLogger(__name__)
+
+# --- LAPISAN PANGGILAN OpenAI (재시도 / 속도 제한 / 중복 요청 병합) ---
+# 모든 세션의 OpenAI 호출이 이 게이트웨이를 거친다.
+# - 429, 5xx, 시간 초과, 연결 오류는 지터를 준 지수 백오프로 다시 시도 (Retry-After 우선)
+# - 동시 요청 수(세마포어)와 분당 요청 수(토큰 버킷)를 조직 한도에 맞춰 제한
+# - 같은 요청이 진행 중이면 새로 호출하지 않고 그 결과를 함께 받는다 ([전송] 두 번 클릭 등)
+
+
+def retryable_errors():
+    # openai는 첫 호출 때 불러온다 (앱 첫 화면의 import 시간 단축)
+    import openai
+
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+
+class LLMBusyError(RuntimeError):
+    pass
+
+
+def request_key(kwargs, scope=None):
+    # scope(세션 ID 등)가 다르면 같은 요청이라도 병합하지 않는다
+    payload = json.dumps([scope, kwargs], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    def __init__(self, max_concurrency, rpm, burst=None, timeout=30.0):
+        self.timeout = timeout
+        self.rate = rpm / 60.0
+        self.capacity = float(burst or max_concurrency)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take_token(self, deadline):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with span("llm.queue_wait"):
+            if not self._semaphore.acquire(timeout=self.timeout):
+                raise LLMBusyError("동시 요청이 너무 많습니다.")
+            if not self._take_token(deadline):
+                self._semaphore.release()
+                raise LLMBusyError("분당 요청 한도에 도달했습니다.")
+
+    def release(self):
+        self._semaphore.release()
+
+
+class _StreamBroadcast:
+    # 하나의 스트림을 여러 구독자에게 처음부터 다시 전달
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    def append(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def subscribe(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                batch = self.chunks[index:]
+                index = len(self.chunks)
+                if not batch:
+                    if self.error is not None:
+                        raise self.error
+                    return
+            yield from batch
+
+
+class LLMGateway:
+    def __init__(self, client, limiter, max_attempts=4, base_delay=0.5, max_delay=20.0, linger=30.0):
+        # 재시도는 여기서만 하도록 SDK 자체 재시도는 끈다
+        self.client = client.with_options(max_retries=0)
+        self.retryable = retryable_errors()
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # 끝난 스트림을 잠시 보관하여, 중단된 화면이 다시 요청하면 그대로 이어 받게 함
+        self.linger = linger
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+        self.stats = {"requests": 0, "coalesced": 0, "retries": 0, "busy": 0, "failed": 0}
+
+    def _backoff(self, attempt, error):
+        # full jitter: 0 ~ base * 2^attempt 사이에서 무작위로 기다려 재시도가 한꺼번에 몰리지 않게 함
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def _call(self, kwargs, max_attempts=None, hold=False):
+        # max_attempts: 대체 모델이 있는 호출은 재시도 횟수를 줄여 빨리 넘어가도록 함
+        # hold: 성공하면 동시 요청 슬롯을 놓지 않고 반환 (스트림은 다 받은 뒤 호출한 쪽에서 release)
+        max_attempts = max_attempts or self.max_attempts
+        for attempt in range(max_attempts):
+            try:
+                self.limiter.acquire()
+            except LLMBusyError:
+                self.stats["busy"] += 1
+                raise
+            try:
+                self.stats["requests"] += 1
+                response = self.client.chat.completions.create(**kwargs)
+            except self.retryable as e:
+                self.limiter.release()
+                if attempt == max_attempts - 1:
+                    self.stats["failed"] += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                self.stats["retries"] += 1
+                logger.warning("OpenAI 호출 실패 (%s), %.1f초 후 다시 시도합니다 (%d/%d)",
+                               type(e).__name__, delay, attempt + 1, max_attempts - 1)
+            except BaseException:
+                self.limiter.release()
+                raise
+            else:
+                if not hold:
+                    self.limiter.release()
+                return response
+            time.sleep(delay)
+
+    def create(self, on_usage=None, scope=None, max_attempts=None, **kwargs):
+        key = request_key(kwargs, scope)
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            response = self._call(kwargs, max_attempts)
+            future.set_result(response)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        # 사용량은 실제로 호출한 쪽에서만 한 번 기록
+        if on_usage is not None:
+            on_usage(response.usage)
+        return response
+
+    def stream(self, on_usage=None, scope=None, max_attempts=None, **kwargs):
+        kwargs["stream"] = True
+        key = request_key(kwargs, scope)
+        now = time.monotonic()
+        with self._lock:
+            for old_key in [k for k, b in self._streams.items() if b.done and now - b.finished_at > self.linger]:
+                del self._streams[old_key]
+            broadcast = self._streams.get(key)
+            leader = broadcast is None or broadcast.error is not None
+            if leader:
+                broadcast = self._streams[key] = _StreamBroadcast()
+            else:
+                self.stats["coalesced"] += 1
+        if leader:
+            # 화면(스크립트 스레드)이 rerun으로 중단되어도 응답은 끝까지 받아 둔다
+            threading.Thread(
+                target=self._produce, args=(broadcast, kwargs, on_usage, max_attempts), name="inq-llm-stream",
+                daemon=True,
+            ).start()
+        return broadcast.subscribe()
+
+    def _produce(self, broadcast, kwargs, on_usage, max_attempts=None):
+        error = None
+        try:
+            # 첫 청크를 받기 전의 실패만 재시도 (중간에 끊긴 응답은 이어 붙일 수 없음).
+            # 동시 요청 슬롯은 스트림을 끝까지 받을 때까지 유지하여 OPENAI_MAX_CONCURRENCY가 진행 중인 스트림 수를 제한
+            stream = self._call(kwargs, max_attempts, hold=True)
+            try:
+                for chunk in stream:
+                    if chunk.usage is not None and on_usage is not None:
+                        on_usage(chunk.usage)
+                    broadcast.append(chunk)
+            finally:
+                stream.close()
+                self.limiter.release()
+        except Exception as e:
+            error = e
+        finally:
+            broadcast.finish(error)
+
+    def snapshot(self):
+        with self._lock:
+            in_flight = len(self._calls) + sum(1 for b in self._streams.values() if not b.done)
+        return {**self.stats, "in_flight": in_flight}
+
+
+def stream_text(chunks):
+    return "".join(
+        chunk.choices[0].delta.content or "" for chunk in chunks if chunk.choices
+    )
+
+
+# --- PERUTEAN MODEL (호출 종류별 모델 선택 / 대체 모델) ---
+# 호출 종류(hint, history_summary, feedback, guard)마다 모델 목록을 두고 앞에서부터 시도한다.
+# 앞 모델이 시간 초과·한도 초과·서버 오류로 실패하면(첫 청크 전) 다음 모델로 넘어간다.
+# "local:<모델>"은 LOCAL_LLM_BASE_URL의 OpenAI 호환 서버(Ollama, vLLM 등)로 보낸다.
+# 실제로 응답한 모델과 지연 시간은 on_usage(usage, model, latency_ms)로 알려 모델별 비용·지연을 기록한다.
+
+LOCAL_PREFIX = "local:"
+
+
+def fallback_errors():
+    return retryable_errors() + (LLMBusyError,)
+
+
+class ModelRouter:
+    def __init__(self, routes, gateways, timeouts=None, primary_attempts=2, on_snapshot=None, snapshot_interval=30.0):
+        # routes: 호출 종류 -> 모델 목록, gateways: "openai"/"local" -> 게이트웨이를 돌려주는 함수.
+        # 경로에 쓰이는 게이트웨이는 여기서(스크립트 스레드) 미리 만들어 두어, 피드백·판정 작업처럼
+        # 스크립트 밖의 스레드에서 라우터를 쓸 때 st.cache_resource 함수를 부르지 않게 한다
+        self.routes = routes
+        kinds = {"local" if spec.startswith(LOCAL_PREFIX) else "openai" for specs in routes.values() for spec in specs}
+        self.gateways = {kind: gateways[kind]() for kind in kinds}
+        self.timeouts = timeouts or {}
+        self.primary_attempts = primary_attempts
+        self.fallback = fallback_errors()
+        self.stats = {"fallbacks": 0}
+        # on_snapshot(snapshot): 호출이 끝날 때 snapshot_interval마다 한 번 게이트웨이·라우터 상태를 알림
+        self.on_snapshot = on_snapshot
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_at = 0.0
+
+    def models(self, call):
+        return self.routes[call]
+
+    def primary(self, call):
+        return self.routes[call][0]
+
+    def _target(self, spec):
+        if spec.startswith(LOCAL_PREFIX):
+            return self.gateways["local"], spec[len(LOCAL_PREFIX):]
+        return self.gateways["openai"], spec
+
+    def _attempts(self, call):
+        # (모델 이름, 게이트웨이, 실제 모델 ID, 재시도 횟수, 요청 인자)를 시도할 순서대로
+        specs = self.models(call)
+        for index, spec in enumerate(specs):
+            gateway, model = self._target(spec)
+            options = {"model": model}
+            if self.timeouts.get(call):
+                options["timeout"] = self.timeouts[call]
+            last = index == len(specs) - 1
+            yield spec, gateway, options, None if last else self.primary_attempts, last
+
+    def _on_fallback(self, call, spec, error):
+        self.stats["fallbacks"] += 1
+        logger.warning("%s 호출이 %s에서 실패하여 (%s) 대체 모델로 넘어갑니다.", call, spec, type(error).__name__)
+
+    def snapshot(self):
+        return {**self.stats, "gateways": {kind: gateway.snapshot() for kind, gateway in self.gateways.items()}}
+
+    def _maybe_snapshot(self):
+        now = time.monotonic()
+        if self.on_snapshot is None or now - self._snapshot_at < self.snapshot_interval:
+            return
+        self._snapshot_at = now
+        try:
+            self.on_snapshot(self.snapshot())
+        except Exception:
+            logger.exception("LLM 호출 상태 기록 중 오류가 발생했습니다.")
+
+    @staticmethod
+    def _usage(on_usage, spec, started):
+        if on_usage is None:
+            return None
+        return lambda usage: on_usage(usage, spec, round((time.perf_counter() - started) * 1000, 1))
+
+    def create(self, call, on_usage=None, scope=None, **kwargs):
+        try:
+            for spec, gateway, options, attempts, last in self._attempts(call):
+                started = time.perf_counter()
+                try:
+                    with span("llm.call", call=call, model=spec):
+                        return gateway.create(
+                            on_usage=self._usage(on_usage, spec, started), scope=scope, max_attempts=attempts,
+                            **options, **kwargs,
+                        )
+                except self.fallback as e:
+                    if last:
+                        raise
+                    self._on_fallback(call, spec, e)
+        finally:
+            self._maybe_snapshot()
+
+    def stream(self, call, on_usage=None, scope=None, **kwargs):
+        try:
+            for spec, gateway, options, attempts, last in self._attempts(call):
+                started = time.perf_counter()
+                chunks = gateway.stream(
+                    on_usage=self._usage(on_usage, spec, started), scope=scope, max_attempts=attempts,
+                    **options, **kwargs,
+                )
+                try:
+                    # 첫 청크가 오기 전까지만 대체 모델로 넘어갈 수 있음
+                    with span("llm.first_chunk", call=call, model=spec):
+                        first = next(chunks, None)
+                except self.fallback as e:
+                    if last:
+                        raise
+                    self._on_fallback(call, spec, e)
+                    continue
+                if first is not None:
+                    yield first
+                    yield from chunks
+                return
+        finally:
+            self._maybe_snapshot()
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm_gateway():
+    max_concurrency = int(st.secrets.get("OPENAI_MAX_CONCURRENCY", 16))
+    limiter = RateLimiter(
+        max_concurrency=max_concurrency,
+        rpm=float(st.secrets.get("OPENAI_RPM_LIMIT", 500)),
+        burst=int(st.secrets.get("OPENAI_BURST", max_concurrency)),
+        timeout=float(st.secrets.get("OPENAI_QUEUE_TIMEOUT", 30)),
+    )
+    return LLMGateway(
+        get_openai_client(),
+        limiter,
+        max_attempts=int(st.secrets.get("OPENAI_MAX_ATTEMPTS", 4)),
+        base_delay=float(st.secrets.get("OPENAI_BACKOFF_BASE", 0.5)),
+        max_delay=float(st.secrets.get("OPENAI_BACKOFF_MAX", 20)),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_local_llm_gateway():
+    # 교실 안의 로컬 서버는 처리 능력이 작으므로 동시 요청 수를 따로 제한
+    max_concurrency = int(st.secrets.get("LOCAL_LLM_MAX_CONCURRENCY", 4))
+    limiter = RateLimiter(
+        max_concurrency=max_concurrency,
+        rpm=float(st.secrets.get("LOCAL_LLM_RPM_LIMIT", 600)),
+        timeout=float(st.secrets.get("LOCAL_LLM_QUEUE_TIMEOUT", 60)),
+    )
+    return LLMGateway(get_local_llm_client(), limiter, max_attempts=int(st.secrets.get("LOCAL_LLM_MAX_ATTEMPTS", 2)))
+
+
+def _route(call, primary, fallback):
+    models = [st.secrets.get(f"MODEL_{call.upper()}", primary)]
+    fallback = st.secrets.get(f"MODEL_{call.upper()}_FALLBACK", fallback)
+    if fallback and fallback != models[0]:
+        models.append(fallback)
+    return models
+
+
+@st.cache_resource(show_spinner=False)
+def get_model_router():
+    # 짧은 소크라테스식 힌트는 작은 모델, page_4 평가는 큰 모델. secrets의 MODEL_<종류>[_FALLBACK]로 변경
+    routes = {
+        "hint": _route("hint", "gpt-4o-mini", "gpt-4o"),
+        "history_summary": _route("history_summary", st.secrets.get("HISTORY_SUMMARY_MODEL", "gpt-4o-mini"), "gpt-4o"),
+        "feedback": _route("feedback", "gpt-4o", "gpt-4o-mini"),
+        # inq_guard의 정답 노출 판정 (백그라운드)
+        "guard": _route("guard", "gpt-4o-mini", None),
+    }
+    if st.secrets.get("LLM_OFFLINE", False):
+        # 인터넷이 없는 교실: 모든 호출을 로컬 서버의 한 모델로
+        local_model = LOCAL_PREFIX + st.secrets.get("LOCAL_LLM_MODEL", "llama3.1")
+        routes = {call: [local_model] for call in routes}
+    sink = get_metrics_sink()
+    return ModelRouter(
+        routes,
+        gateways={"openai": get_llm_gateway, "local": get_local_llm_gateway},
+        timeouts={call: float(st.secrets.get(f"LLM_TIMEOUT_{call.upper()}", default))
+                  for call, default in (("hint", 20), ("history_summary", 60), ("feedback", 90), ("guard", 20))},
+        primary_attempts=int(st.secrets.get("LLM_PRIMARY_ATTEMPTS", 2)),
+        # 동시 요청·재시도·대체 모델 전환 상태를 교사 앱 관리자 화면에서 보도록 메트릭 로그에 남김
+        on_snapshot=lambda snapshot: sink.emit({"type": "llm", "ts": time.time(), **snapshot}),
+        snapshot_interval=float(st.secrets.get("LLM_SNAPSHOT_INTERVAL", 30)),
+    )
@@ -0,0 +1,236 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+# --- METRIK (OpenAI 사용량 기록) ---
+# 요청마다 usage 블록(prompt / cached / completion 토큰)을 JSONL 파일에 남긴다.
+# 캐시 적중률과 세션당 비용은 교사 앱에서 이 로그를 summarize_usage로 집계해 확인한다
+# (프로세스 메모리에는 누계를 두지 않음).
+
+# USD / 1M 토큰 (input, cached input, output)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+
+def _field(obj, name, default=None):
+    # openai 버전에 따라 usage 하위 항목이 모델 객체 또는 dict로 들어온다
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    value = getattr(obj, name, None)
+    if value is None and getattr(obj, "model_extra", None):
+        value = obj.model_extra.get(name)
+    return default if value is None else value
+
+
+def usage_to_dict(usage):
+    details = _field(usage, "prompt_tokens_details")
+    return {
+        "prompt_tokens": int(_field(usage, "prompt_tokens", 0)),
+        "cached_tokens": int(_field(details, "cached_tokens", 0)),
+        "completion_tokens": int(_field(usage, "completion_tokens", 0)),
+    }
+
+
+def estimate_cost(model, usage):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # 날짜가 붙은 스냅샷 이름(gpt-4o-2024-08-06 등)은 가장 긴 접두어로 매칭
+        matches = [name for name in MODEL_PRICES if model.startswith(name)]
+        if not matches:
+            return 0.0
+        prices = MODEL_PRICES[max(matches, key=len)]
+    input_price, cached_price, output_price = prices
+    uncached = usage["prompt_tokens"] - usage["cached_tokens"]
+    return (
+        uncached * input_price
+        + usage["cached_tokens"] * cached_price
+        + usage["completion_tokens"] * output_price
+    ) / 1_000_000
+
+
+class MetricsSink:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                logger.warning("메트릭 기록 실패: %s", e)
+
+    def record_usage(self, session_id, call, model, usage, latency_ms=None):
+        if usage is None:
+            return None
+        data = usage_to_dict(usage)
+        cost = estimate_cost(model, data)
+        event = {
+            "type": "usage", "ts": time.time(), "session_id": session_id, "call": call, "model": model,
+            **data, "cost_usd": round(cost, 6),
+        }
+        if latency_ms is not None:
+            event["latency_ms"] = latency_ms
+        self.emit(event)
+        return data
+
+
+@st.cache_resource(show_spinner=False)
+def get_metrics_sink():
+    return MetricsSink(st.secrets.get("METRICS_LOG_PATH", "inq_metrics.jsonl"))
+
+
+# --- TRACING (단계별 지연 시간) ---
+# 외부 호출과 페이지 렌더링을 span으로 감싸 소요 시간을 같은 JSONL 파일에 남긴다.
+# 꺼져 있으면 span()은 미리 만들어 둔 빈 컨텍스트를 돌려주므로 비용이 거의 없다.
+
+_sink = None
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("sink", "name", "tags", "start")
+
+    def __init__(self, sink, name, tags):
+        self.sink = sink
+        self.name = name
+        self.tags = tags
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is None:
+            status = "ok"
+        elif issubclass(exc_type, Exception):
+            status = "error"
+        else:
+            # st.rerun()/st.stop() 등 정상 흐름의 중단
+            status = "interrupted"
+        self.sink.emit({
+            "type": "span", "ts": time.time(), "name": self.name,
+            "duration_ms": round(duration * 1000, 3), "status": status, **self.tags,
+        })
+        return False
+
+    def set(self, key, value):
+        # 첫 토큰까지의 시간처럼 span 도중에 알게 되는 값을 덧붙임
+        self.tags[key] = value
+
+
+def span(name, **tags):
+    sink = _sink
+    if sink is None:
+        return _NOOP_SPAN
+    return _Span(sink, name, tags)
+
+
+@st.cache_resource(show_spinner=False)
+def init_tracing():
+    # 백그라운드 스레드에서도 쓸 수 있도록 st 호출 없이 모듈 전역에 sink를 둔다
+    global _sink
+    if st.secrets.get("TRACING_ENABLED", False):
+        _sink = get_metrics_sink()
+    return _sink is not None
+
+
+def load_events(path, event_type=None, limit=50000):
+    # 파일 끝의 limit개 행만 메모리에 유지
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = deque(f, maxlen=limit)
+    except OSError:
+        return []
+    events = []
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if event_type is None or event.get("type") == event_type:
+            events.append(event)
+    return events
+
+
+def _percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize_spans(events, group_by=("name",)):
+    groups = {}
+    for event in events:
+        key = tuple(event.get(field) for field in group_by)
+        groups.setdefault(key, []).append(event)
+    rows = []
+    for key, items in groups.items():
+        durations = sorted(item["duration_ms"] for item in items)
+        rows.append({
+            **dict(zip(group_by, key)),
+            "count": len(items),
+            "p50_ms": _percentile(durations, 50),
+            "p95_ms": _percentile(durations, 95),
+            "p99_ms": _percentile(durations, 99),
+            "max_ms": durations[-1],
+            "errors": sum(1 for item in items if item.get("status") == "error"),
+        })
+    rows.sort(key=lambda row: row["p95_ms"], reverse=True)
+    return rows
+
+
+def summarize_usage(events, group_by=("model",)):
+    # 모델(또는 호출 종류, 세션)별 요청 수, 토큰, 프롬프트 캐시 적중률, 비용, 응답 완료까지의 지연 시간
+    groups = {}
+    for event in events:
+        key = tuple(event.get(field) for field in group_by)
+        groups.setdefault(key, []).append(event)
+    rows = []
+    for key, items in groups.items():
+        latencies = sorted(item["latency_ms"] for item in items if item.get("latency_ms") is not None)
+        cost = sum(item.get("cost_usd", 0.0) for item in items)
+        prompt_tokens = sum(item.get("prompt_tokens", 0) for item in items)
+        cached_tokens = sum(item.get("cached_tokens", 0) for item in items)
+        rows.append({
+            **dict(zip(group_by, key)),
+            "requests": len(items),
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "cache_hit_rate": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else None,
+            "completion_tokens": sum(item.get("completion_tokens", 0) for item in items),
+            "cost_usd": round(cost, 4),
+            "cost_per_request_usd": round(cost / len(items), 6),
+            "p50_ms": _percentile(latencies, 50) if latencies else None,
+            "p95_ms": _percentile(latencies, 95) if latencies else None,
+        })
+    rows.sort(key=lambda row: row["cost_usd"], reverse=True)
+    return rows
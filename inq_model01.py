@@ -1,38 +1,58 @@
-import pymysql
-from openai import OpenAI
-import os
-import json
-from dotenv import load_dotenv
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pymongo import MongoClient as PyMongoClient
 import streamlit as st
-import httpx # <-- DITAMBAHKAN: HTTP 클라이언트 초기화를 위해 필요
+from inq_persist import get_persistence_worker, KIND_TRANSCRIPT, KIND_FEEDBACK, KIND_FLAG
+from inq_context import build_history, new_summary_state
+from inq_metrics import get_metrics_sink, init_tracing, span
+from inq_llm import get_model_router, stream_text
+from inq_cache import HintCache
+from inq_session import get_session_manager, track_session
+from inq_guard import TurnGuard, excerpt, judge_messages, parse_verdict
 
 # --- KONFIGURASI AWAL ---
 
 # Lingkungan: st.secrets digunakan di Streamlit Cloud.
 # load_dotenv()
 
-# Ambil API Key dari Streamlit Secrets
-OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
-MODEL = 'gpt-4o'
+# 모델은 호출 종류별로 inq_llm.get_model_router()가 고른다 (힌트: gpt-4o-mini, 피드백: gpt-4o, 실패 시 대체 모델).
+# secrets의 MODEL_HINT / MODEL_FEEDBACK / MODEL_HISTORY_SUMMARY (+ _FALLBACK)로 변경하고,
+# "local:<모델>"이나 LLM_OFFLINE으로 LOCAL_LLM_BASE_URL의 로컬 서버를 쓸 수 있다.
+# 토큰 단위 스트리밍 출력 여부 (secrets에서 끌 수 있음)
+STREAM_RESPONSES = st.secrets.get("STREAM_RESPONSES", True)
+# 한 번의 요청에 보낼 최대 토큰 수와 응답용 여유분 (초과 시 오래된 대화를 요약)
+CONTEXT_TOKEN_BUDGET = int(st.secrets.get("CONTEXT_TOKEN_BUDGET", 12000))
+CONTEXT_RESERVE_TOKENS = int(st.secrets.get("CONTEXT_RESERVE_TOKENS", 1500))
+# page_4 피드백을 미리 생성하는 백그라운드 스레드 수
+FEEDBACK_MAX_WORKERS = int(st.secrets.get("FEEDBACK_MAX_WORKERS", 8))
+# 끝난 피드백 작업을 보관하는 시간(초). [마침] 뒤 탭을 닫은 학생의 결과가 메모리에 계속 남지 않도록 정리
+FEEDBACK_JOB_TTL = float(st.secrets.get("FEEDBACK_JOB_TTL", 1800))
+# 누적 대화 목록에서 항상 펼쳐 보여줄 최근 메시지 수와, 이전 대화 한 페이지의 메시지 수
+TRANSCRIPT_RECENT_MESSAGES = int(st.secrets.get("TRANSCRIPT_RECENT_MESSAGES", 10))
+TRANSCRIPT_PAGE_MESSAGES = int(st.secrets.get("TRANSCRIPT_PAGE_MESSAGES", 20))
+# 같은 내용을 이 시간(초) 안에 다시 [전송]하면 두 번 클릭으로 보고 새로 호출하지 않음
+DOUBLE_SUBMIT_WINDOW = float(st.secrets.get("DOUBLE_SUBMIT_WINDOW", 3))
+# 첫 질문(학습지 문제)에 대한 힌트를 학생들 사이에서 재사용 (기본 꺼짐)
+HINT_CACHE_ENABLED = st.secrets.get("HINT_CACHE_ENABLED", False)
+# 튜터 응답의 정답 노출 검사 (inq_guard). 규칙에 걸리면 백그라운드에서 모델로 판정 후 교사용으로 기록
+GUARD_ENABLED = st.secrets.get("GUARD_ENABLED", True)
+GUARD_ESCALATE = st.secrets.get("GUARD_ESCALATE", True)
+GUARD_MAX_WORKERS = int(st.secrets.get("GUARD_MAX_WORKERS", 4))
 
 # OpenAI API Pengaturan
-# httpx.Client를 명시적으로 사용하여 환경 프록시 설정 충돌(TypeError) 방지
-try:
-    # 기본 HTTPX 클라이언트 생성
-    base_http_client = httpx.Client()
-    client = OpenAI(api_key=OPENAI_API_KEY, http_client=base_http_client)
-except Exception:
-    # 예외 발생 시 표준 초기화로 대체
-    client = OpenAI(api_key=OPENAI_API_KEY)
-
-
-# MongoDB Pengaturan
-mongo_client = PyMongoClient(st.secrets["MONGO_URI"])
-db = mongo_client[st.secrets["MONGO_DB"]]
-collection = db[st.secrets["MONGO_COLLECTION"]]
-collection_feedback = db[st.secrets["MONGO_COLLECTION_FEEDBACK"]]
+# 클라이언트는 inq_clients에서 프로세스 단위로 캐시되어 모든 세션이 연결 풀을 공유한다.
+# 실제 호출은 inq_llm 게이트웨이(재시도, 동시성/분당 요청 제한, 중복 요청 병합)를 거치며,
+# 게이트웨이와 클라이언트는 처음 API를 호출할 때 만들어진다.
+
+# 단계별 지연 시간 기록 (secrets의 TRACING_ENABLED로 켬, 꺼져 있으면 span은 아무 일도 하지 않음)
+init_tracing()
+
+
+# Penyimpanan Pengaturan
+# 대화 기록과 피드백은 inq_storage 백엔드(secrets의 STORAGE_BACKEND: mongo / sql / sqlite) 하나에 저장.
+# 연결은 저장 워커(inq_persist.get_persistence_worker)가 처음 저장할 때(page_4) 만든다.
 
 # Halaman Pengaturan Dasar
 st.set_page_config(page_title="수학여행 도우미", page_icon="🧠", layout="wide")
@@ -85,7 +105,48 @@ initial_prompt = '''
   - 마지막엔 “이제 [다음] 버튼을 눌러 마무리해 줘!”라고 안내해.
 '''
 
+# 아래 고정 프롬프트들은 모든 학생·세션에서 바이트 단위로 동일하게 유지해야
+# OpenAI 프롬프트 캐시(동일 접두어 재사용)가 적용된다. 세션별 내용은 항상 뒤쪽 메시지로 보낸다.
+
+HISTORY_SUMMARY_PROMPT = '''
+너는 학생과 수학여행 도우미의 대화를 요약하는 역할을 한다.
+사용자 메시지로 [이전 요약]과 그 이후의 대화가 주어진다.
+학생이 시도한 개념, 실수와 수정 과정, 도우미가 던진 질문이 드러나도록 5문장 이내로 갱신된 요약을 작성하라.
+정답이나 풀이 과정은 요약에 새로 추가하지 마라.
+'''
+
+FEEDBACK_PROMPT = '''
+사용자 메시지로 학생과 수학여행 도우미의 대화 기록이 주어집니다.
+
+학생이 "마침"이라고 말했습니다. 이제 다음 지침에 따라 대화 내용을 요약하고 피드백을 제공하세요:
+
+📌 **1. 대화 내용 요약**
+- 학생이 어떤 개념을 시도했고, 어떤 실수를 했으며 어떻게 수정했는지를 중심으로 요약하세요.
+- 가독성을 위해 문단마다 줄바꿈을 사용하세요.
+
+💬 **2. 문제해결 능력 피드백**
+- 개념 적용, 전략적 사고, 자기주도성, 오개념 교정 등의 측면에서 평가하세요.
+
+🧾 **3. 수학적 결과 또는 전략 정리 (조건 분기)**
+
+- **학생이 대화 중 스스로 정확한 정답을 제시한 경우**:
+  - 문제 풀이 과정을 간결히 요약하고, LaTeX 수식으로 최종 정답을 제시하세요.
+  - 그리고 이어서 **난이도를 높인 새로운 수학 문제를 제시하세요.**
+
+- **정답을 제시하지 못했거나 오답을 제시한 경우**:
+- 정답을 언급하지 않고 문제 해결에 필요한 핵심 개념, 공식, 전략만 정리하세요. 설명은 생략하고 수식만 제시하세요.
+
+- 마지막으로, **"이제 [다음] 버튼을 눌러 마무리해 줘!"** 라고 안내해주세요.
+
+반드시 위 형식을 따르고, 항목 순서를 변경하지 마세요.
+'''
+
 # --- SESSION STATE INISIALISASI ---
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex # 사용량 메트릭 집계용
+# 세션 등록 및 메모리 관리 (유휴 시간이 지나 디스크로 옮겨진 대화 상태는 여기서 복원)
+if track_session(st.session_state["session_id"]):
+    st.toast("이전 대화를 불러왔습니다.")
 if "messages" not in st.session_state:
     st.session_state["messages"] = []
 if "chat_ended" not in st.session_state:
@@ -94,11 +155,13 @@ if "user_said_finish" not in st.session_state:
     st.session_state["user_said_finish"] = False
 if "step" not in st.session_state:
     st.session_state["step"] = 1 # <--- Mengatur langkah awal
+if "history_summary" not in st.session_state:
+    st.session_state["history_summary"] = new_summary_state()
 
 # --- FUNGSI PENDUKUNG ---
 
-# MongoDB Simpan Fungsi
-def save_to_mongo(all_data):
+# Transkrip Simpan Fungsi (저장 워커 대기열에 등록, 실제 기록은 inq_storage 백엔드가 처리)
+def save_transcript(all_data, summary=None):
     number = st.session_state.get('user_number', '').strip()
     name = st.session_state.get('user_name', '').strip()
 
@@ -106,58 +169,429 @@ def save_to_mongo(all_data):
         st.error("사용자 학번과 이름을 입력해야 합니다.")
         return False
 
-    mongo_client_local = None
+    document = {
+        "number": number,
+        "name": name,
+        "chat": all_data,
+        "summary": summary,
+        "started": st.session_state.get("started_at"),
+        "finished": st.session_state.get("finished_at"),
+        "time": datetime.now()
+    }
+
+    # 저장은 백그라운드 워커가 처리하고 화면은 바로 반환 (DB 장애 시 로컬 저널에 보관)
     try:
-        from pymongo import MongoClient
-        mongo_client_local = MongoClient(st.secrets["MONGO_URI"]) # <-- 로컬 연결 사용
-        db_local = mongo_client_local[st.secrets["MONGO_DB"]]
-        collection_local = db_local[st.secrets["MONGO_COLLECTION"]]
-
-        now = datetime.now()
-
-        document = {
-            "number": number,
-            "name": name,
-            "chat": all_data,
-            "time": now
-        }
-
-        collection_local.insert_one(document)
+        with trace("persist.submit", kind=KIND_TRANSCRIPT):
+            get_persistence_worker().submit(KIND_TRANSCRIPT, document)
         return True
-
     except Exception as e:
-        st.error(f"MongoDB 저장 중 오류가 발생했습니다: {e}")
+        st.error(f"대화 기록 저장 요청 중 오류가 발생했습니다: {e}")
         return False
 
-    finally:
-        if mongo_client_local:
-            mongo_client_local.close()
+
+# Ringkasan Riwayat Fungsi (오래된 대화를 누적 요약으로 접기)
+def summarize_history(previous_summary, messages):
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    # 고정 지침은 system, 매번 달라지는 내용은 user 메시지로 분리 (프롬프트 캐시 접두어 유지)
+    with trace("openai.history_summary"):
+        response = get_model_router().create(
+            "history_summary",
+            on_usage=usage_recorder("history_summary"),
+            messages=[
+                {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+                {"role": "user", "content": f"[이전 요약]\n{previous_summary or '(없음)'}\n\n[이후 대화]\n{transcript}"},
+            ],
+        )
+    return response.choices[0].message.content
+
+
+# Metrik Penggunaan Fungsi
+def usage_recorder(call):
+    # 게이트웨이의 백그라운드 스레드에서 호출되므로 세션 ID와 sink를 미리 꺼내 둔다.
+    # model은 라우터가 실제로 응답을 받은 모델 (대체 모델일 수 있음)
+    session_id = st.session_state.get("session_id", "unknown")
+    sink = get_metrics_sink()
+    return lambda usage, model, latency_ms: sink.record_usage(session_id, call, model, usage, latency_ms)
+
+
+# Pelacakan Fungsi (세션 ID와 현재 단계를 붙여 span 기록)
+def trace(name, **tags):
+    return span(name, session_id=st.session_state.get("session_id"), step=st.session_state.get("step"), **tags)
+
+
+# API 요청 메시지 구성 Fungsi
+def build_messages_for_api(prompt):
+    # 시스템 프롬프트와 문제는 항상 유지하고, 예산을 넘는 대화는 요약으로 대체
+    if "history_summary" not in st.session_state:
+        st.session_state["history_summary"] = new_summary_state()
+    return build_history(
+        initial_prompt,
+        st.session_state["messages"],
+        prompt,
+        st.session_state["history_summary"],
+        budget=CONTEXT_TOKEN_BUDGET,
+        reserve=CONTEXT_RESERVE_TOKENS,
+        summarize=summarize_history,
+    )
+
+
+# 대화 기록 추가 Fungsi
+def append_turn(prompt, answer):
+    st.session_state["messages"].append({"role": "user", "content": prompt})
+    st.session_state["messages"].append({"role": "assistant", "content": answer})
+    st.session_state["last_submit"] = (prompt, time.monotonic())
+
+
+def is_double_submit(prompt):
+    # 응답이 끝난 직후 같은 내용의 [전송]이 다시 들어온 경우
+    last = st.session_state.get("last_submit")
+    messages = st.session_state["messages"]
+    return (
+        last is not None and last[0] == prompt
+        and time.monotonic() - last[1] < DOUBLE_SUBMIT_WINDOW
+        and len(messages) >= 2 and messages[-2]["content"] == prompt
+    )
+
+
+def finish_interrupted_turn(prompt=None):
+    # 스트리밍 도중 rerun으로 중단된 응답은 게이트웨이에서 계속 생성되고 있다.
+    # 같은 내용을 다시 보낸 경우에는 그 요청이 스트림을 이어 받고, 아니면 여기서 기록에 반영
+    turn = st.session_state.get("interrupted_turn")
+    if turn is None or turn["prompt"] == prompt:
+        return turn
+    del st.session_state["interrupted_turn"]
+    try:
+        with st.spinner("이전 응답을 마무리하고 있습니다..."):
+            answer = stream_text(get_model_router().stream("hint", scope=st.session_state["session_id"], **turn["request"]))
+    except Exception as e:
+        st.error(f"이전 응답을 가져오지 못했습니다: {e}")
+        return None
+    if answer:
+        screen_answer(turn["prompt"], answer)
+        append_turn(turn["prompt"], answer)
+        st.session_state["recent_message"] = {"user": turn["prompt"], "assistant": answer}
+    return None
+
+
+# Cache Petunjuk Pembuka Fungsi
+@st.cache_resource(show_spinner=False)
+def get_hint_cache():
+    return HintCache(
+        max_bytes=int(st.secrets.get("HINT_CACHE_MAX_MB", 16)) * 1024 * 1024,
+        ttl=float(st.secrets.get("HINT_CACHE_TTL", 86400)),
+        similarity=float(st.secrets.get("HINT_CACHE_SIMILARITY", 0.9)),
+    )
 
 
 # GPT Respon Generate Fungsi
-def get_chatgpt_response(prompt):
+def get_chatgpt_response(prompt, placeholder=None):
+    if is_double_submit(prompt):
+        return st.session_state["messages"][-1]["content"]
+
+    # 첫 턴만 캐시 대상: 이후 턴은 학생마다 대화가 달라 개인화된 응답이 필요
+    opening = HINT_CACHE_ENABLED and not st.session_state["messages"] and "interrupted_turn" not in st.session_state
+    if opening:
+        with trace("hint_cache.lookup") as s:
+            answer, result = get_hint_cache().get(initial_prompt, get_model_router().primary("hint"), prompt)
+            s.set("result", result)
+        if answer is not None:
+            # 캐시된 힌트도 새 응답과 똑같이 검사하여, 걸리면 이 학생의 턴으로 기록
+            screen_answer(prompt, answer)
+            append_turn(prompt, answer)
+            if placeholder is not None:
+                placeholder.markdown(f"**수학여행 도우미:** {answer}")
+            return answer
+
+    answer, cacheable = request_chatgpt_response(prompt, placeholder)
+    # 오류 응답, 중간에 끊긴 스트림, 정답 노출 검사에 걸린 응답은 반 전체에 재사용되지 않도록 캐시하지 않음
+    if opening and cacheable:
+        get_hint_cache().put(initial_prompt, get_model_router().primary("hint"), prompt, answer)
+    return answer
+
+
+def request_chatgpt_response(prompt, placeholder=None):
+    # 반환값: (응답, 캐시해도 되는지 = 끝까지 정상으로 받아 대화에 반영했고 정답 노출 검사에 걸리지 않았는지)
+    # placeholder가 주어지고 스트리밍이 켜져 있으면 토큰 단위로 출력
+    if STREAM_RESPONSES and placeholder is not None:
+        return stream_chatgpt_response(prompt, placeholder)
+
+    finish_interrupted_turn()
     # 시스템 프롬프트와 현재 대화 기록을 합쳐 API 요청 메시지 구성
-    messages_for_api = [{"role": "system", "content": initial_prompt}] + st.session_state["messages"] + [{"role": "user", "content": prompt}]
+    messages_for_api = build_messages_for_api(prompt)
     
     # Menambahkan penanganan error untuk API call
     try:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages_for_api,
-        )
+        with trace("openai.hint", stream=False):
+            response = get_model_router().create(
+                "hint",
+                on_usage=usage_recorder("hint"),
+                scope=st.session_state["session_id"],
+                messages=messages_for_api,
+            )
         answer = response.choices[0].message.content
+        flagged = screen_answer(prompt, answer)
 
         # Simpan dialog ke session state
-        st.session_state["messages"].append({"role": "user", "content": prompt})
-        st.session_state["messages"].append({"role": "assistant", "content": answer})
-        return answer
+        append_turn(prompt, answer)
+        return answer, not flagged
     except Exception as e:
         st.error(f"OpenAI API 호출 중 오류가 발생했습니다: {e}")
-        return "죄송합니다. 현재 AI 서버에 문제가 발생했습니다. 잠시 후 다시 시도해 주세요."
+        return "죄송합니다. 현재 AI 서버에 문제가 발생했습니다. 잠시 후 다시 시도해 주세요.", False
+
+
+# GPT Respon Streaming Fungsi
+def stream_chatgpt_response(prompt, placeholder):
+    turn = finish_interrupted_turn(prompt)
+    if turn is not None:
+        # 중단된 요청과 같은 내용: 동일한 요청으로 진행 중인 스트림에 다시 연결
+        request = turn["request"]
+    else:
+        request = {
+            "messages": build_messages_for_api(prompt),
+            "stream_options": {"include_usage": True},
+        }
+
+    answer_parts = []
+    finished = False
+    # 스트림을 끝까지 받았는지 (오류로 끊기면 부분 응답만 기록에 남기고 캐시하지 않음)
+    completed = False
+    flagged = False
+    guard = start_guard(prompt)
+    try:
+        with trace("openai.hint", stream=True) as s:
+            started = time.perf_counter()
+            # 마지막 청크에만 usage가 담겨 오며, 게이트웨이가 실제 호출한 요청에 대해서만 기록
+            stream = get_model_router().stream(
+                "hint", on_usage=usage_recorder("hint"), scope=st.session_state["session_id"], **request
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not answer_parts:
+                        s.set("ttft_ms", round((time.perf_counter() - started) * 1000, 1))
+                    answer_parts.append(delta)
+                    if guard is not None:
+                        guard.feed(delta)
+                    placeholder.markdown(f"**수학여행 도우미:** {''.join(answer_parts)}▌")
+        finished = completed = True
+    except Exception as e:
+        finished = True
+        st.error(f"OpenAI API 호출 중 오류가 발생했습니다: {e}")
+        if not answer_parts:
+            return "죄송합니다. 현재 AI 서버에 문제가 발생했습니다. 잠시 후 다시 시도해 주세요.", False
+    finally:
+        # rerun 등으로 중단되면 기록에 반영하지 않고 요청을 남겨 두었다가 이어 받음
+        if finished:
+            st.session_state.pop("interrupted_turn", None)
+        else:
+            st.session_state["interrupted_turn"] = {"prompt": prompt, "request": request}
+
+    answer = "".join(answer_parts)
+    if guard is not None:
+        # 중간에 끊긴 부분 응답도 기록에 남으므로 함께 검사
+        flagged = bool(guard.finish())
+    if answer:
+        append_turn(prompt, answer)
+    placeholder.markdown(f"**수학여행 도우미:** {answer}")
+    return answer, completed and bool(answer) and not flagged
+
+
+# --- PENJAGA JAWABAN (정답 노출 검사) ---
+# 사전 검사는 스트리밍 루프 안에서 바로 하고, 모델 판정과 기록은 별도 스레드에서 하여 턴 지연에 영향이 없다.
+
+@st.cache_resource(show_spinner=False)
+def get_guard_executor():
+    return ThreadPoolExecutor(max_workers=GUARD_MAX_WORKERS, thread_name_prefix="inq-guard")
+
+
+def escalate_flag(record, problem, answer, router, sink, worker):
+    # 판정 스레드에서 실행: router/sink/worker는 스크립트 스레드에서 꺼내 넘겨받는다
+    if router is not None:
+        try:
+            with span("guard.escalate", session_id=record["session_id"], rules=",".join(record["rules"])):
+                response = router.create(
+                    "guard",
+                    on_usage=lambda usage, model, latency_ms: sink.record_usage(
+                        record["session_id"], "guard", model, usage, latency_ms
+                    ),
+                    messages=judge_messages(problem, record["prompt"], answer),
+                )
+            record["verdict"], record["reason"] = parse_verdict(response.choices[0].message.content)
+            record["model"] = response.model
+        except Exception as e:
+            record["verdict"], record["reason"] = "error", str(e)
+    else:
+        record["verdict"], record["reason"] = "unchecked", ""
+    worker.submit(KIND_FLAG, record)
+    return record["verdict"]
+
+
+def start_guard(prompt):
+    # 이번 턴의 응답 검사기. 세션 정보는 스크립트 스레드에서 미리 꺼내 둔다
+    messages = st.session_state["messages"]
+    context = {
+        "session_id": st.session_state["session_id"],
+        "number": st.session_state.get("user_number", "").strip(),
+        "name": st.session_state.get("user_name", "").strip(),
+        "turn": sum(1 for m in messages if m["role"] == "user") + 1,
+        "problem": messages[0]["content"] if messages else prompt,
+    }
+
+    def on_flag(rules, text, position):
+        record = {
+            "session_id": context["session_id"], "number": context["number"], "name": context["name"],
+            "turn": context["turn"], "rules": rules, "excerpt": excerpt(text, position), "prompt": prompt,
+            "verdict": None, "reason": None, "model": None, "time": datetime.now(),
+        }
+        # 응답이 아직 스트리밍 중이어도 규칙에 걸린 부분까지로 바로 판정을 시작.
+        # on_flag는 스트리밍 루프(스크립트 스레드)에서 불리므로 여기서 공유 객체를 꺼낸다
+        get_guard_executor().submit(
+            escalate_flag, record, context["problem"], text,
+            get_model_router() if GUARD_ESCALATE else None, get_metrics_sink(), get_persistence_worker(),
+        )
+
+    return TurnGuard(on_flag) if GUARD_ENABLED else None
+
+
+def screen_answer(prompt, answer):
+    # 스트리밍이 아닌 경로(캐시된 힌트 포함): 응답 전체를 한 번 검사. 규칙에 걸렸으면 True
+    guard = start_guard(prompt)
+    if guard is not None and answer:
+        return bool(guard.finish(answer))
+    return False
+
+
+# --- PEMBUATAN FEEDBACK DI LATAR BELAKANG ---
+# [마침]을 누르는 순간 page_4 피드백 생성을 시작하고, 세션 ID로 작업을 찾아 결과만 가져온다.
+
+@st.cache_resource(show_spinner=False)
+def get_feedback_executor():
+    return ThreadPoolExecutor(max_workers=FEEDBACK_MAX_WORKERS, thread_name_prefix="inq-feedback")
+
+
+@st.cache_resource(show_spinner=False)
+def get_feedback_jobs():
+    # session_id -> (대화 길이, Future, 시작 시각). rerun이나 다른 탭에서도 같은 작업을 공유
+    return {}, threading.Lock()
+
+
+def _prune_feedback_jobs(jobs, now):
+    # 잠금을 잡은 상태에서 호출: 끝난 지 오래된(시작 후 FEEDBACK_JOB_TTL 경과) 작업을 지운다
+    expired = [sid for sid, (_, future, started) in jobs.items() if future.done() and now - started > FEEDBACK_JOB_TTL]
+    for sid in expired:
+        del jobs[sid]
+
+
+def generate_feedback(session_id, messages, router, sink):
+    # 백그라운드 스레드에서 실행되므로 st.session_state와 st.cache_resource 함수에 접근하지 않는다.
+    # router와 sink는 스크립트 스레드에서 꺼내 넘겨받는다
+    chat_history = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    feedback_messages = [
+        {"role": "system", "content": FEEDBACK_PROMPT},
+        {"role": "user", "content": f"다음은 학생과 수학여행 도우미의 대화 기록입니다:\n\n{chat_history}"},
+    ]
+    with span("openai.feedback", session_id=session_id):
+        response = router.create(
+            "feedback",
+            on_usage=lambda usage, model, latency_ms: sink.record_usage(
+                session_id, "feedback", model, usage, latency_ms
+            ),
+            messages=feedback_messages
+        )
+    return response.choices[0].message.content
+
+
+def start_feedback_job():
+    # 같은 세션·같은 대화에 대해서는 이미 시작된 작업을 반환하여 중복 호출을 막는다
+    session_id = st.session_state["session_id"]
+    # 메모리 상한 때문에 보관 파일로 옮긴 메시지까지 포함한 전체 대화
+    messages = get_session_manager().full_history(session_id, st.session_state["messages"])
+    jobs, lock = get_feedback_jobs()
+    now = time.monotonic()
+    with lock:
+        _prune_feedback_jobs(jobs, now)
+        job = jobs.get(session_id)
+        if job is None or job[0] != len(messages):
+            if job is not None:
+                job[1].cancel() # 대화가 이어진 경우 이전 작업은 버림
+            future = get_feedback_executor().submit(
+                generate_feedback, session_id, messages, get_model_router(), get_metrics_sink()
+            )
+            job = (len(messages), future, now)
+            jobs[session_id] = job
+    return job[1]
+
+
+def discard_feedback_job():
+    jobs, lock = get_feedback_jobs()
+    with lock:
+        jobs.pop(st.session_state.get("session_id"), None)
+        _prune_feedback_jobs(jobs, time.monotonic())
+
+
+# --- TRANSKRIP (누적 대화 목록) ---
+SPEAKER_LABELS = {"user": "You", "assistant": "수학여행 도우미"}
+
+
+def sync_transcript():
+    # 메시지마다 한 번만 markdown으로 변환해 두고, 새로 추가된 메시지만 덧붙인다
+    messages = st.session_state["messages"]
+    blocks = st.session_state.setdefault("transcript_blocks", [])
+    keys = st.session_state.setdefault("transcript_keys", [])
+
+    # 기록이 초기화되거나 잘린 경우 달라진 지점부터 다시 변환
+    synced = 0
+    while synced < min(len(keys), len(messages)) and keys[synced] == id(messages[synced]):
+        synced += 1
+    del blocks[synced:], keys[synced:]
+
+    for message in messages[synced:]:
+        label = SPEAKER_LABELS.get(message["role"])
+        blocks.append(f"**{label}:** {message['content']}" if label else "")
+        keys.append(id(message))
+    return blocks
+
+
+def render_transcript():
+    archived = st.session_state.get("archived_messages", 0)
+    if archived:
+        st.caption(f"오래된 대화 {archived}개는 서버에 따로 보관되어 여기에는 표시되지 않습니다. (저장과 피드백에는 포함)")
+    blocks = sync_transcript()
+    if not blocks:
+        st.write("아직 대화 기록이 없습니다.")
+        return
+
+    # 📌 최근 대화에 이미 표시된 마지막 주고받기는 중복 출력하지 않음
+    shown = len(blocks)
+    messages = st.session_state["messages"]
+    recent_user = st.session_state["recent_message"]["user"]
+    if recent_user and shown >= 2 and messages[-2]["content"] == recent_user:
+        shown -= 2
+    if shown == 0:
+        st.write("최근 대화 외의 기록이 없습니다.")
+        return
+
+    # 오래된 대화는 접어 두고, 펼쳤을 때도 한 페이지만 하나의 요소로 출력
+    start = max(0, shown - TRANSCRIPT_RECENT_MESSAGES)
+    if start > 0 and st.toggle(f"이전 대화 {start}개 보기", key="show_older_transcript"):
+        pages = (start + TRANSCRIPT_PAGE_MESSAGES - 1) // TRANSCRIPT_PAGE_MESSAGES
+        page = pages
+        if pages > 1:
+            page = st.number_input("페이지", min_value=1, max_value=pages, value=pages, key="transcript_page")
+        lo = (page - 1) * TRANSCRIPT_PAGE_MESSAGES
+        hi = min(start, lo + TRANSCRIPT_PAGE_MESSAGES)
+        st.markdown("\n\n".join(blocks[lo:hi]))
+
+    for block in blocks[start:shown]:
+        st.markdown(block)
 
 
 # Session State Reset Fungsi
 def reset_session_state():
+    discard_feedback_job()
+    get_session_manager().discard(st.session_state.get("session_id"))
     for key in list(st.session_state.keys()):
         if key not in ["user_number", "user_name"]: # 학번과 이름은 유지
             del st.session_state[key]
@@ -236,6 +670,10 @@ def page_3():
     if "messages" not in st.session_state:
         st.session_state["messages"] = []
 
+    # 교사용 통계(마침까지 걸린 시간)를 위해 대화 시작 시각을 기록
+    if "started_at" not in st.session_state:
+        st.session_state["started_at"] = datetime.now()
+
     if "user_input_temp" not in st.session_state:
         st.session_state["user_input_temp"] = ""
 
@@ -265,11 +703,13 @@ def page_3():
         )
 
         col1, col2 = st.columns([1, 1])
+        # 스트리밍 응답이 표시될 자리
+        stream_placeholder = st.empty()
 
         with col1:
             if st.button("전송"):
                 if user_input.strip():
-                    assistant_response = get_chatgpt_response(user_input)
+                    assistant_response = get_chatgpt_response(user_input, stream_placeholder)
                     st.session_state["recent_message"] = {"user": user_input, "assistant": assistant_response}
                     st.session_state["user_input_temp"] = ""
                     st.rerun()
@@ -277,13 +717,19 @@ def page_3():
         with col2:
             if st.button("마침"):
                 final_input = "마침"
-                assistant_response = get_chatgpt_response(final_input)
+                assistant_response = get_chatgpt_response(final_input, stream_placeholder)
                 st.session_state["recent_message"] = {"user": final_input, "assistant": assistant_response}
                 st.session_state["user_input_temp"] = ""
                 st.session_state["chat_ended"] = True
                 st.session_state["user_said_finish"] = True
+                st.session_state["finished_at"] = datetime.now()
+                # 학생이 [다음]을 누르기 전에 피드백 생성을 미리 시작
+                start_feedback_job()
                 st.rerun()
 
+    # 이번 실행에서 다시 보내지 않은, 중단된 응답을 기록에 반영
+    finish_interrupted_turn()
+
     # Output
     st.subheader("📌 최근 대화")
     if st.session_state["recent_message"]["user"] or st.session_state["recent_message"]["assistant"]:
@@ -293,14 +739,7 @@ def page_3():
         st.write("아직 최근 대화가 없습니다.")
 
     st.subheader("📜 누적 대화 목록")
-    if st.session_state["messages"]:
-        for message in st.session_state["messages"]:
-            if message["role"] == "user":
-                st.write(f"**You:** {message['content']}")
-            elif message["role"] == "assistant":
-                st.write(f"**수학여행 도우미:** {message['content']}")
-    else:
-        st.write("아직 대화 기록이 없습니다.")
+    render_transcript()
 
     col3, col4 = st.columns([1, 1])
     with col3:
@@ -319,7 +758,7 @@ def page_3():
             st.button("다음", key="page3_next_button_disabled", disabled=True)
 
 
-# MySQL Simpan Feedback Fungsi (참고: MongoDB 저장 함수와 별개로 피드백 테이블에 저장)
+# Feedback Simpan Fungsi (참고: 대화 기록과 같은 저장소의 피드백 테이블/컬렉션에 저장)
 def save_feedback_to_db(feedback):
     number = st.session_state.get('user_number', '').strip()
     name = st.session_state.get('user_name', '').strip()
@@ -328,32 +767,19 @@ def save_feedback_to_db(feedback):
         st.error("사용자 학번과 이름을 입력해야 합니다.")
         return False
 
-    try:
-        # Perhatikan: Pastikan Anda telah menginstal pymysql
-        db = pymysql.connect(
-            host=st.secrets["DB_HOST"],
-            user=st.secrets["DB_USER"],
-            password=st.secrets["DB_PASSWORD"],
-            database=st.secrets["DB_DATABASE"],
-            charset="utf8mb4",
-            autocommit=True
-        )
-        cursor = db.cursor()
-        now = datetime.now()
-
-        sql = """
-        INSERT INTO feedback (number, name, feedback, time)
-        VALUES (%s, %s, %s, %s)
-        """
-        val = (number, name, feedback, now)
+    record = {
+        "number": number,
+        "name": name,
+        "feedback": feedback,
+        "time": datetime.now()
+    }
 
-        cursor.execute(sql, val)
-        cursor.close()
-        db.close()
-        st.success("피드백이 성공적으로 저장되었습니다.")
+    # 백그라운드 워커가 여러 건을 묶어서 한 번에 INSERT
+    try:
+        with trace("persist.submit", kind=KIND_FEEDBACK):
+            get_persistence_worker().submit(KIND_FEEDBACK, record)
+        st.info("피드백 저장이 대기열에 등록되었습니다.")
         return True
-    except pymysql.MySQLError as db_err:
-        st.error(f"DB 처리 중 오류가 발생했습니다: {db_err}")
     except Exception as e:
         st.error(f"알 수 없는 오류가 발생했습니다: {e}")
     return False
@@ -373,50 +799,16 @@ def page_4():
             st.rerun()
             return
 
-        chat_history = "\n".join(f"{msg['role']}: {msg['content']}" for msg in st.session_state["messages"])
-
-        if st.session_state.get("user_said_finish", False):
-            prompt = f"""
-다음은 학생과 수학여행 도우미의 대화 기록입니다:
-
-{chat_history}
-
----
-
-학생이 "마침"이라고 말했습니다. 이제 다음 지침에 따라 대화 내용을 요약하고 피드백을 제공하세요:
-
-📌 **1. 대화 내용 요약**
-- 학생이 어떤 개념을 시도했고, 어떤 실수를 했으며 어떻게 수정했는지를 중심으로 요약하세요.
-- 가독성을 위해 문단마다 줄바꿈을 사용하세요.
-
-💬 **2. 문제해결 능력 피드백**
-- 개념 적용, 전략적 사고, 자기주도성, 오개념 교정 등의 측면에서 평가하세요.
-
-🧾 **3. 수학적 결과 또는 전략 정리 (조건 분기)**
-
-- **학생이 대화 중 스스로 정확한 정답을 제시한 경우**:
-  - 문제 풀이 과정을 간결히 요약하고, LaTeX 수식으로 최종 정답을 제시하세요.
-  - 그리고 이어서 **난이도를 높인 새로운 수학 문제를 제시하세요.**
-
-- **정답을 제시하지 못했거나 오답을 제시한 경우**:
-- 정답을 언급하지 않고 문제 해결에 필요한 핵심 개념, 공식, 전략만 정리하세요. 설명은 생략하고 수식만 제시하세요.
-
-- 마지막으로, **"이제 [다음] 버튼을 눌러 마무리해 줘!"** 라고 안내해주세요.
-
-반드시 위 형식을 따르고, 항목 순서를 변경하지 마세요.
-"""
-        else:
+        if not st.session_state.get("user_said_finish", False):
             st.session_state["experiment_plan"] = "현재 대화가 명확히 종료되지 않았습니다. 이전 페이지로 돌아가서 '마침' 버튼을 누르거나 대화를 계속 진행해주세요."
             st.warning(st.session_state["experiment_plan"])
             return # '마침' 입력이 없으면 함수 종료
 
-        # OpenAI API 호출 (hanya jika ada prompt valid)
+        # [마침] 때 시작된 작업을 이어받음 (없으면 지금 시작). rerun해도 API는 한 번만 호출된다
+        future = start_feedback_job()
         try:
-            response = client.chat.completions.create(
-                model=MODEL,
-                messages=[{"role": "system", "content": prompt}]
-            )
-            st.session_state["experiment_plan"] = response.choices[0].message.content
+            with st.spinner("피드백을 생성하고 있습니다..."), trace("feedback.wait"):
+                st.session_state["experiment_plan"] = future.result()
         except Exception as e:
             st.error(f"피드백 생성 중 OpenAI API 오류: {e}")
             st.session_state["experiment_plan"] = "피드백 생성 중 오류가 발생했습니다."
@@ -426,16 +818,19 @@ def page_4():
     st.subheader("📋 생성된 피드백")
     st.write(st.session_state["experiment_plan"])
 
-    # Data untuk disimpan ke MongoDB
-    all_data_to_store = st.session_state["messages"] + [{"role": "assistant", "content": st.session_state["experiment_plan"]}]
+    # Data untuk disimpan (대화 기록)
+    # 피드백은 대화 기록에 붙이지 않고 요약 필드로 따로 저장 (교사 화면에서 본문 없이 바로 조회)
+    all_data_to_store = get_session_manager().full_history(st.session_state["session_id"], st.session_state["messages"])
 
-    # Menyimpan ke MongoDB
+    # Menyimpan ke penyimpanan (저장 워커를 거쳐 STORAGE_BACKEND에 기록)
     if "feedback_saved" not in st.session_state:
         st.session_state["feedback_saved"] = False
 
     if not st.session_state["feedback_saved"]:
-        if save_to_mongo(all_data_to_store):
+        if save_transcript(all_data_to_store, st.session_state["experiment_plan"]):
             st.session_state["feedback_saved"] = True
+            st.info("대화 기록 저장이 대기열에 등록되었습니다.")
+            discard_feedback_job() # 저장까지 끝났으므로 작업 결과는 더 이상 필요 없음
         else:
             st.error("저장에 실패했습니다. 다시 시도해주세요.")
     else:
@@ -460,11 +855,12 @@ def page_4():
 
 # --- LOGIKA UTAMA ---
 
-if st.session_state["step"] == 1:
-    page_1()
-elif st.session_state["step"] == 2:
-    page_2()
-elif st.session_state["step"] == 3:
-    page_3()
-elif st.session_state["step"] == 4:
-    page_4()
+with trace("page.render"):
+    if st.session_state["step"] == 1:
+        page_1()
+    elif st.session_state["step"] == 2:
+        page_2()
+    elif st.session_state["step"] == 3:
+        page_3()
+    elif st.session_state["step"] == 4:
+        page_4()
@@ -0,0 +1,291 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import streamlit as st
+
+from inq_storage import get_storage
+from inq_metrics import get_metrics_sink, span
+
+logger = logging.getLogger(__name__)
+
+# --- PENYIMPANAN LATAR BELAKANG (write-behind) ---
+# 저장 요청은 제한된 크기의 큐에 넣고 즉시 반환한다. 백그라운드 스레드가 묶어서
+# 저장소 백엔드(inq_storage)에 insert_many / 다중 행 INSERT로 기록하고, DB가 응답하지 않으면
+# 로컬 저널 파일에 덧붙여 두었다가 다음 시작 시(또는 DB가 복구되었을 때) 다시 기록한다.
+# 묶음 중 한 건이 거부되면(열 길이 초과 등) 나머지는 한 건씩 다시 기록하고, DB가 살아 있는데도
+# 여러 번 거부된 기록은 저널에서 빼서 dead-letter 파일로 옮긴다.
+
+KIND_TRANSCRIPT = "transcript"
+KIND_FEEDBACK = "feedback"
+KIND_FLAG = "flag"
+
+# 한 건씩 다시 기록하다가 이만큼 연속으로 실패하면 DB 장애로 보고 나머지는 저널에 보관
+MAX_FAILURE_STREAK = 3
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"JSON으로 변환할 수 없는 값: {type(value)!r}")
+
+
+def _decode(obj):
+    if set(obj) == {"$date"}:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+class PersistenceWorker:
+    def __init__(self, writers, journal_path, max_queue=1000, batch_size=50,
+                 flush_interval=0.5, replay_interval=30.0, prepare=None, max_attempts=5,
+                 dead_letter_path=None):
+        self.writers = writers
+        # prepare: 첫 기록 전에 워커 스레드에서 한 번 실행 (테이블/열 생성 등)
+        self.prepare = prepare
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.replay_interval = replay_interval
+        self.max_attempts = max_attempts
+        self.dead_letter_path = dead_letter_path or journal_path + ".dead"
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._journal_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_replay = 0.0
+        self._last_success = 0.0
+        self.stats = {"queued": 0, "written": 0, "journaled": 0, "replayed": 0, "failed_batches": 0,
+                      "dead_lettered": 0}
+
+        self._thread = threading.Thread(target=self._run, name="inq-persist", daemon=True)
+        self._thread.start()
+
+    # -- API untuk halaman --
+    def submit(self, kind, record):
+        # UI는 기다리지 않는다: 큐가 가득 차면 저널에 바로 기록
+        try:
+            self._queue.put_nowait((kind, record))
+            self.stats["queued"] += 1
+            return "queued"
+        except queue.Full:
+            self._append_journal([(kind, record)])
+            return "journaled"
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        self._thread.join(timeout)
+        # 남은 요청은 저널에 보관
+        leftovers = []
+        while True:
+            try:
+                leftovers.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if leftovers:
+            self._append_journal(leftovers)
+
+    # -- Worker --
+    def _run(self):
+        if self.prepare is not None:
+            try:
+                self.prepare()
+            except Exception as e:
+                # 권한이 없으면 교사 앱(ensure_indexes) 또는 관리자가 만든 스키마를 그대로 사용
+                logger.warning("저장소 스키마 확인에 실패했습니다: %s", e)
+        self.replay_journal()
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write_batch(batch)
+            elif time.monotonic() - self._last_replay > self.replay_interval:
+                self.replay_journal()
+        # 종료 직전 남은 항목을 한 번 더 기록
+        batch = self._next_batch(block=False)
+        while batch:
+            self._write_batch(batch)
+            batch = self._next_batch(block=False)
+
+    def _next_batch(self, block=True):
+        batch = []
+        try:
+            if block:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+            else:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch):
+        # batch: 큐의 (kind, record) 또는 저널에서 읽은 (kind, record, 실패 횟수)
+        # 반환값: 저장하지 못한 항목 수
+        failed = []
+        by_kind = {}
+        for item in batch:
+            kind, record = item[0], item[1]
+            attempts = item[2] if len(item) > 2 else 0
+            by_kind.setdefault(kind, []).append((record, attempts))
+        for kind, entries in by_kind.items():
+            failed.extend((kind, record, attempts) for record, attempts in self._write_entries(kind, entries))
+        if failed:
+            self._journal_failures(failed)
+        return len(failed)
+
+    def _write_entries(self, kind, entries):
+        try:
+            self._write(kind, [record for record, _ in entries])
+            return []
+        except Exception as e:
+            logger.warning("%s %d건 저장 실패: %s", kind, len(entries), e)
+            self.stats["failed_batches"] += 1
+            if len(entries) == 1:
+                return [(entries[0][0], self._count_failure(entries[0][1]))]
+
+        # 한 건 때문에 묶음 전체가 거부되었을 수 있으므로 한 건씩 다시 시도
+        failed = []
+        streak = 0
+        for index, (record, attempts) in enumerate(entries):
+            if streak >= MAX_FAILURE_STREAK:
+                # DB 장애로 보이면 남은 항목은 시도하지 않고 실패 횟수도 세지 않음
+                failed.extend(entries[index:])
+                break
+            try:
+                self._write(kind, [record])
+                streak = 0
+            except Exception as e:
+                logger.warning("%s 1건 저장 실패: %s", kind, e)
+                streak += 1
+                failed.append((record, self._count_failure(attempts)))
+        if failed:
+            logger.warning("%s %d/%d건을 저널에 보관합니다.", kind, len(failed), len(entries))
+        return failed
+
+    def _write(self, kind, records):
+        with span("db.write", kind=kind, records=len(records)):
+            self.writers[kind](records)
+        self.stats["written"] += len(records)
+        self._last_success = time.monotonic()
+
+    def _count_failure(self, attempts):
+        # DB가 최근에 다른 기록을 받았다면 이 기록 자체의 문제로 보고 횟수를 센다.
+        # 장애 중의 실패까지 세면 멀쩡한 기록이 dead-letter로 빠지므로 제외
+        if time.monotonic() - self._last_success < max(60.0, 2 * self.replay_interval):
+            return attempts + 1
+        return attempts
+
+    # -- Journal --
+    def _journal_failures(self, failed):
+        dead = [item for item in failed if item[2] >= self.max_attempts]
+        if dead:
+            for kind, _, attempts in dead:
+                logger.error("%s 1건이 %d번 거부되어 %s로 옮깁니다.", kind, attempts, self.dead_letter_path)
+            self._append_lines(self.dead_letter_path, dead)
+            self.stats["dead_lettered"] += len(dead)
+        retry = [item for item in failed if item[2] < self.max_attempts]
+        if retry:
+            self._append_journal(retry)
+
+    def _append_journal(self, items):
+        self._append_lines(self.journal_path, items)
+        self.stats["journaled"] += len(items)
+
+    def _append_lines(self, path, items):
+        with self._journal_lock:
+            with open(path, "a", encoding="utf-8") as f:
+                for item in items:
+                    entry = {"kind": item[0], "record": item[1]}
+                    if len(item) > 2 and item[2]:
+                        entry["attempts"] = item[2]
+                    f.write(json.dumps(entry, default=_encode, ensure_ascii=False))
+                    f.write("\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def replay_journal(self):
+        self._last_replay = time.monotonic()
+        # 처리 중인 저널은 다른 이름으로 옮겨, 새로 실패한 항목과 섞이지 않도록 함
+        replay_path = self.journal_path + ".replay"
+        with self._journal_lock:
+            if os.path.exists(self.journal_path):
+                if os.path.exists(replay_path):
+                    # 이전 재처리 도중 종료된 경우 남은 파일에 이어 붙임
+                    with open(replay_path, "a", encoding="utf-8") as dst, \
+                            open(self.journal_path, encoding="utf-8") as src:
+                        dst.write(src.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, replay_path)
+            elif not os.path.exists(replay_path):
+                return 0
+
+        items = []
+        with open(replay_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line, object_hook=_decode)
+                except ValueError:
+                    logger.error("저널의 손상된 행을 건너뜁니다: %r", line[:200])
+                    continue
+                items.append((entry["kind"], entry["record"], entry.get("attempts", 0)))
+
+        replayed = 0
+        for start in range(0, len(items), self.batch_size):
+            chunk = items[start:start + self.batch_size]
+            # 실패한 항목은 _write_batch가 다시 저널(또는 dead-letter)에 기록
+            replayed += len(chunk) - self._write_batch(chunk)
+        os.remove(replay_path)
+        self.stats["replayed"] += replayed
+        if items:
+            logger.info("저널에서 %d/%d건을 다시 저장했습니다.", replayed, len(items))
+        return replayed
+
+
+@st.cache_resource(show_spinner=False)
+def get_persistence_worker():
+    # 대화 기록과 피드백은 같은 저장소 백엔드(inq_storage)에 기록.
+    # 답 노출 판정은 FLAGS_STORAGE_BACKEND가 있으면 그 백엔드(교사 앱이 읽는 쪽)에 기록
+    storage = get_storage()
+    flags_backend = st.secrets.get("FLAGS_STORAGE_BACKEND")
+    flag_storage = get_storage(flags_backend) if flags_backend else storage
+
+    def prepare():
+        storage.ensure_schema()
+        if flag_storage is not storage:
+            flag_storage.ensure_schema()
+
+    # 교사 앱이 백엔드가 다른지 확인할 수 있도록 메트릭 로그에 남김
+    get_metrics_sink().emit({
+        "type": "storage", "ts": time.time(), "backend": storage.name, "flags_backend": flag_storage.name,
+    })
+    worker = PersistenceWorker(
+        writers={
+            KIND_TRANSCRIPT: storage.write_transcripts,
+            KIND_FEEDBACK: storage.write_feedback,
+            KIND_FLAG: flag_storage.write_flags,
+        },
+        journal_path=st.secrets.get("PERSIST_JOURNAL_PATH", "inq_persist_journal.jsonl"),
+        max_queue=int(st.secrets.get("PERSIST_MAX_QUEUE", 1000)),
+        batch_size=int(st.secrets.get("PERSIST_BATCH_SIZE", 50)),
+        prepare=prepare,
+        max_attempts=int(st.secrets.get("PERSIST_MAX_ATTEMPTS", 5)),
+        dead_letter_path=st.secrets.get("PERSIST_DEAD_LETTER_PATH"),
+    )
+    atexit.register(worker.stop)
+    return worker
@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+import streamlit as st
+
+from inq_cache import approx_size
+from inq_metrics import get_metrics_sink
+
+logger = logging.getLogger(__name__)
+
+# --- MANAJER SESI (세션별 메모리 상한 / 유휴 세션 정리) ---
+# 학생 탭을 닫지 않고 떠나면 대화 기록이 서버 메모리에 계속 남는다. 이 관리자는
+# - 매 실행마다 세션을 등록하고 세션 상태의 크기를 잰다
+# - 유휴 시간이 SESSION_IDLE_TIMEOUT을 넘은 세션의 대화 상태를 디스크로 내보내고 메모리에서 지운다
+#   (학생이 돌아오면 다음 실행에서 그대로 복원)
+# - 세션당 대화 기록이 SESSION_MAX_HISTORY_KB를 넘으면, 이미 요약(inq_context)에 반영되어
+#   API 요청에 쓰이지 않는 메시지를 디스크 보관 파일로 옮긴다 (저장·피드백 시 다시 합침)
+# - 연결이 끊긴 뒤 SESSION_RECONNECT_GRACE가 지나도 돌아오지 않은 세션은 목록과 디스크에서 지운다
+#   (Streamlit은 끊긴 세션을 2분 동안 재연결할 수 있게 보관하므로, 그 사이에는 보관 파일을 지우지 않음)
+# 세션 수와 메모리 사용량은 주기적으로 메트릭 로그에 {"type": "sessions"}로 남긴다.
+
+# 유휴 세션을 내보낼 때 디스크로 옮기는 키와, 다시 만들 수 있어 그냥 지우는 키
+OFFLOAD_KEYS = ("messages", "recent_message", "user_input_temp", "experiment_plan", "history_summary",
+                "interrupted_turn", "archived_messages")
+DERIVED_KEYS = ("transcript_blocks", "transcript_keys")
+
+
+def _default(value):
+    if hasattr(value, "isoformat"):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"{type(value).__name__}는 저장할 수 없습니다.")
+
+
+def _object_hook(obj):
+    if set(obj) == {"$date"}:
+        from datetime import datetime
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+class _Entry:
+    __slots__ = ("state", "runtime_id", "last_seen", "bytes", "offloaded", "inactive_since")
+
+    def __init__(self, state, runtime_id):
+        self.state = state
+        self.runtime_id = runtime_id
+        self.last_seen = time.monotonic()
+        self.bytes = 0
+        self.offloaded = False
+        # 정리 스레드가 처음으로 연결이 끊긴 것을 본 시각
+        self.inactive_since = None
+
+
+class SessionManager:
+    def __init__(self, offload_dir, idle_timeout=1800.0, max_history_bytes=512 * 1024,
+                 sweep_interval=60.0, is_active=None, on_snapshot=None, reconnect_grace=300.0):
+        self.offload_dir = offload_dir
+        self.idle_timeout = idle_timeout
+        self.max_history_bytes = max_history_bytes
+        self.sweep_interval = sweep_interval
+        # is_active(runtime_id): 연결이 살아 있는 세션인지 (None이면 항상 살아 있다고 봄)
+        self.is_active = is_active
+        # 연결이 끊긴 세션을 지우기 전까지 재연결을 기다리는 시간(초)
+        self.reconnect_grace = reconnect_grace
+        self.on_snapshot = on_snapshot
+        os.makedirs(offload_dir, exist_ok=True)
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.stats = {"offloaded": 0, "restored": 0, "archived_messages": 0, "closed": 0}
+
+        self._thread = threading.Thread(target=self._run, name="inq-session-sweeper", daemon=True)
+        self._thread.start()
+
+    def _path(self, session_id, kind):
+        return os.path.join(self.offload_dir, f"{session_id}.{kind}")
+
+    # -- API untuk halaman (스크립트 스레드에서 호출) --
+    def touch(self, session_id, state, runtime_id=None):
+        # state: 이 세션의 세션 상태 (스크립트 밖에서도 쓸 수 있는 객체)
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = self._sessions[session_id] = _Entry(state, runtime_id)
+            entry.state = state
+            entry.runtime_id = runtime_id
+            entry.last_seen = time.monotonic()
+            entry.inactive_since = None
+            restored = entry.offloaded
+            if restored:
+                self._restore(session_id, state)
+                entry.offloaded = False
+            entry.bytes = self._measure(state)
+        return restored
+
+    def cap_history(self, session_id, state):
+        # 요약에 이미 반영된 messages[1:upto]만 보관 파일로 옮긴다 (messages[0]은 문제이므로 유지)
+        messages = state["messages"] if "messages" in state else None
+        summary = state["history_summary"] if "history_summary" in state else None
+        if not messages or not summary or approx_size(messages) <= self.max_history_bytes:
+            return 0
+        folded = messages[1:summary["upto"]]
+        if not folded:
+            return 0
+        with open(self._path(session_id, "archive.jsonl"), "a", encoding="utf-8") as f:
+            for message in folded:
+                f.write(json.dumps(message, ensure_ascii=False) + "\n")
+        del messages[1:summary["upto"]]
+        summary["upto"] = 1
+        state["archived_messages"] = (state["archived_messages"] if "archived_messages" in state else 0) + len(folded)
+        self.stats["archived_messages"] += len(folded)
+        return len(folded)
+
+    def full_history(self, session_id, messages):
+        # 보관 파일로 옮긴 메시지를 원래 자리(messages[0] 다음)에 다시 끼워 넣은 전체 대화 기록
+        path = self._path(session_id, "archive.jsonl")
+        if not messages or not os.path.exists(path):
+            return list(messages)
+        with open(path, encoding="utf-8") as f:
+            archived = [json.loads(line) for line in f if line.strip()]
+        return messages[:1] + archived + messages[1:]
+
+    def discard(self, session_id):
+        # 처음으로 돌아가거나 세션이 끝났을 때 메모리 목록과 디스크 파일을 정리
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        for kind in ("offload.json.z", "archive.jsonl"):
+            try:
+                os.remove(self._path(session_id, kind))
+            except FileNotFoundError:
+                pass
+
+    def snapshot(self):
+        with self._lock:
+            entries = list(self._sessions.values())
+        sizes = [e.bytes for e in entries if not e.offloaded]
+        return {
+            "sessions": len(entries),
+            "in_memory": len(sizes),
+            "offloaded_sessions": len(entries) - len(sizes),
+            "bytes": sum(sizes),
+            "max_session_bytes": max(sizes, default=0),
+            **self.stats,
+        }
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    # -- Sweeper --
+    def _run(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+                if self.on_snapshot is not None:
+                    self.on_snapshot(self.snapshot())
+            except Exception:
+                logger.exception("세션 정리 중 오류가 발생했습니다.")
+
+    def sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            items = list(self._sessions.items())
+        for session_id, entry in items:
+            if self.is_active is not None and entry.runtime_id is not None and not self.is_active(entry.runtime_id):
+                # 잠깐 끊긴 연결(와이파이 등)은 곧 같은 세션으로 돌아오므로, 유예 시간이 지나야 지운다
+                if entry.inactive_since is None:
+                    entry.inactive_since = now
+                if now - entry.inactive_since > self.reconnect_grace:
+                    self.discard(session_id)
+                    self.stats["closed"] += 1
+                    continue
+            else:
+                entry.inactive_since = None
+            if not entry.offloaded and now - entry.last_seen > self.idle_timeout:
+                with self._lock:
+                    # 잠금을 기다리는 동안 학생이 돌아왔으면 건너뜀
+                    if entry.offloaded or time.monotonic() - entry.last_seen <= self.idle_timeout:
+                        continue
+                    try:
+                        self._offload(session_id, entry)
+                    except (OSError, TypeError, ValueError) as e:
+                        # 내보내지 못한 세션은 메모리에 그대로 둔다
+                        logger.warning("세션 %s를 디스크로 옮기지 못했습니다: %s", session_id, e)
+
+    def _offload(self, session_id, entry):
+        state = entry.state
+        data = {key: state[key] for key in OFFLOAD_KEYS if key in state}
+        payload = zlib.compress(json.dumps(data, ensure_ascii=False, default=_default).encode("utf-8"))
+        with open(self._path(session_id, "offload.json.z"), "wb") as f:
+            f.write(payload)
+        for key in OFFLOAD_KEYS + DERIVED_KEYS:
+            if key in state:
+                del state[key]
+        entry.offloaded = True
+        entry.bytes = 0
+        self.stats["offloaded"] += 1
+        logger.info("유휴 세션 %s의 상태 %d바이트를 디스크로 옮겼습니다.", session_id, len(payload))
+
+    def _restore(self, session_id, state):
+        path = self._path(session_id, "offload.json.z")
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()), object_hook=_object_hook)
+        except FileNotFoundError:
+            logger.warning("세션 %s의 내보낸 상태 파일이 없습니다.", session_id)
+            return
+        for key, value in data.items():
+            state[key] = value
+        os.remove(path)
+        self.stats["restored"] += 1
+
+    @staticmethod
+    def _measure(state):
+        return sum(approx_size(state[key]) for key in OFFLOAD_KEYS + DERIVED_KEYS if key in state)
+
+
+def _runtime_is_active(runtime_id):
+    from streamlit.runtime import Runtime
+
+    # AppTest 등 런타임 없이 실행될 때는 연결 여부를 알 수 없으므로 살아 있다고 봄
+    if not Runtime.exists():
+        return True
+    return Runtime.instance().is_active_session(runtime_id)
+
+
+@st.cache_resource(show_spinner=False)
+def get_session_manager():
+    sink = get_metrics_sink()
+    return SessionManager(
+        offload_dir=st.secrets.get("SESSION_OFFLOAD_DIR", "inq_sessions"),
+        idle_timeout=float(st.secrets.get("SESSION_IDLE_TIMEOUT", 1800)),
+        max_history_bytes=int(st.secrets.get("SESSION_MAX_HISTORY_KB", 512)) * 1024,
+        sweep_interval=float(st.secrets.get("SESSION_SWEEP_INTERVAL", 60)),
+        is_active=_runtime_is_active,
+        reconnect_grace=float(st.secrets.get("SESSION_RECONNECT_GRACE", 300)),
+        on_snapshot=lambda snapshot: sink.emit({"type": "sessions", "ts": time.time(), **snapshot}),
+    )
+
+
+def track_session(session_id):
+    # 스크립트 실행마다 맨 처음 호출. 유휴 정리로 내보낸 상태가 있으면 복원하고 True를 반환
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return False
+    manager = get_session_manager()
+    restored = manager.touch(session_id, ctx.session_state, ctx.session_id)
+    manager.cap_history(session_id, ctx.session_state)
+    return restored
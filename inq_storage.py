@@ -0,0 +1,521 @@
+import json
+import logging
+import re
+from datetime import datetime, time as dt_time, timedelta
+
+import streamlit as st
+
+from inq_codec import FORMAT_COMPACT_V1, FORMAT_LEGACY, decode_transcript, encode_transcript
+
+logger = logging.getLogger(__name__)
+
+# --- PENYIMPANAN (저장소 백엔드 공통 인터페이스) ---
+# 학생 앱(대화 기록·피드백 저장)과 교사 앱(목록·대화 조회)이 같은 인터페이스로 하나의 DB를 쓴다.
+# secrets의 STORAGE_BACKEND로 고른다: "sql"(PostgreSQL/MySQL 등, STORAGE_URL), "sqlite"(로컬 파일), "mongo".
+# 저장은 저장 워커가 모은 여러 건을 한 번의 다중 행 INSERT / insert_many로 기록한다.
+
+# 레코드 형식 (모든 백엔드 공통)
+#   transcript: {"number", "name", "chat": [{"role", "content"}, ...], "summary": page_4 피드백, "time": datetime,
+#                "started": 대화 시작 시각, "finished": [마침] 시각}
+#   feedback:   {"number", "name", "feedback", "time": datetime}
+#   flag:       {"session_id", "number", "name", "turn", "rules": [규칙 이름], "excerpt", "prompt",
+#                "verdict": leak/ok/unknown/unchecked/error, "reason", "model", "time"}  (inq_guard)
+#   목록 조회 결과: {"id", "number", "name", "time", "turns"}
+#   내보내기(iter_transcript_batches) 결과: 목록 조회 결과 + {"started", "finished", "summary", "chat"}
+# TRANSCRIPT_FORMAT=1이면 대화 본문은 inq_codec 압축 형식(format=1)으로 chat_blob에, 요약은 summary에 따로 저장한다.
+# 예전 형식(format=0/NULL)의 행은 chat에 요약까지 포함된 JSON 목록이 들어 있고 summary는 비워 둔다
+# (요약이 두 곳에 있으면 화면·내보내기·통계에 두 번 나타난다). 내보내기는 read_transcript_summary로 다시 나눈다.
+
+
+def encode_chat(chat):
+    # 공백 없는 JSON 텍스트 (한글은 그대로 저장)
+    return json.dumps(chat, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_chat(value):
+    # jsonb 열이면 이미 리스트로, text 열이면 문자열로 들어온다
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("utf-8")
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def transcript_fields(record, transcript_format):
+    chat = record["chat"]
+    summary = record.get("summary")
+    fields = {
+        "summary": summary,
+        "turns": sum(1 for m in chat if m["role"] == "user"),
+        "started": record.get("started"),
+        "finished": record.get("finished"),
+    }
+    if transcript_format == FORMAT_LEGACY:
+        # 예전 형식을 읽는 앱과 함께 쓸 때: 요약을 마지막 assistant 메시지로 붙인 JSON 목록
+        if summary is not None:
+            chat = chat + [{"role": "assistant", "content": summary}]
+        fields.update({"format": FORMAT_LEGACY, "chat": chat, "chat_blob": None, "summary": None})
+    else:
+        fields.update({"format": FORMAT_COMPACT_V1, "chat": None, "chat_blob": encode_transcript(chat)})
+    return fields
+
+
+def read_transcript(chat, chat_blob, transcript_format):
+    if transcript_format == FORMAT_COMPACT_V1:
+        return decode_transcript(chat_blob)
+    return decode_chat(chat) if chat else None
+
+
+def read_transcript_summary(chat, chat_blob, transcript_format, summary):
+    # 내보내기·통계용: (요약을 뺀 대화, 요약). 예전 형식의 행은 page_4에서만 저장되므로
+    # 마지막 assistant 메시지가 요약이다
+    messages = read_transcript(chat, chat_blob, transcript_format) or []
+    if transcript_format == FORMAT_COMPACT_V1 or not messages or messages[-1].get("role") != "assistant":
+        return messages, summary
+    if summary is not None and messages[-1].get("content") != summary:
+        return messages, summary
+    return messages[:-1], messages[-1].get("content")
+
+
+def _prefix_pattern(value):
+    # 접두어 LIKE 패턴. 완성된 상수 문자열로 넘겨야 PostgreSQL이 text_pattern_ops 인덱스를 쓴다
+    return value.replace("/", "//").replace("%", "/%").replace("_", "/_") + "%"
+
+
+def _day_end(date_to):
+    return datetime.combine(date_to + timedelta(days=1), dt_time.min)
+
+
+class StorageBackend:
+    name = "base"
+
+    def ensure_schema(self):
+        pass
+
+    def write_transcripts(self, records):
+        raise NotImplementedError
+
+    def write_feedback(self, records):
+        raise NotImplementedError
+
+    def write_flags(self, records):
+        raise NotImplementedError
+
+    def list_flags(self, number="", name="", date_from=None, date_to=None, limit=200):
+        # 답 노출 의심 턴을 최신순으로
+        raise NotImplementedError
+
+    def list_records(self, cursor=None, number="", name="", date_from=None, date_to=None, limit=50):
+        # cursor: 이전 페이지 마지막 행의 (time, id). 반환값은 (records, has_next)
+        raise NotImplementedError
+
+    def watermark(self):
+        # 새 레코드가 생겼는지 확인하기 위한 가벼운 값
+        raise NotImplementedError
+
+    def get_chat(self, record_id):
+        raise NotImplementedError
+
+    def get_summary(self, record_id):
+        # 대화 본문을 읽거나 풀지 않고 page_4 요약만 가져옴 (예전 형식의 행은 None)
+        raise NotImplementedError
+
+    def iter_transcript_batches(self, number="", name="", date_from=None, date_to=None, batch_size=500):
+        # 조건에 맞는 모든 대화 기록을 오래된 순으로 batch_size개씩 나누어 돌려줌.
+        # 서버 측 커서로 읽으므로 전체 결과를 메모리에 올리지 않는다
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# --- SQL (PostgreSQL / MySQL / SQLite) ---
+
+class SQLStorage(StorageBackend):
+    name = "sql"
+
+    def __init__(self, engine, read_engine=None, transcript_format=FORMAT_COMPACT_V1):
+        from sqlalchemy import (
+            BigInteger, Column, DateTime, Index, Integer, LargeBinary, MetaData, SmallInteger, String, Table, Text,
+        )
+
+        self.engine = engine
+        self.read_engine = read_engine or engine
+        self.transcript_format = transcript_format
+        metadata = MetaData()
+        id_type = BigInteger().with_variant(Integer, "sqlite")
+        self.qna = Table(
+            "qna", metadata,
+            Column("id", id_type, primary_key=True, autoincrement=True),
+            Column("number", String(32), nullable=False),
+            Column("name", String(64), nullable=False),
+            Column("chat", Text),
+            Column("time", DateTime, nullable=False),
+            Column("format", SmallInteger),
+            Column("chat_blob", LargeBinary),
+            Column("summary", Text),
+            Column("turns", Integer),
+            Column("started", DateTime),
+            Column("finished", DateTime),
+        )
+        # 기존 qna 테이블에 없으면 ALTER TABLE로 추가하는 열
+        self.added_columns = ["format", "chat_blob", "summary", "turns", "started", "finished"]
+        self.feedback = Table(
+            "feedback", metadata,
+            Column("id", id_type, primary_key=True, autoincrement=True),
+            Column("number", String(32), nullable=False),
+            Column("name", String(64), nullable=False),
+            Column("feedback", Text, nullable=False),
+            Column("time", DateTime, nullable=False),
+        )
+        self.flags = Table(
+            "guard_flags", metadata,
+            Column("id", id_type, primary_key=True, autoincrement=True),
+            Column("session_id", String(64)),
+            Column("number", String(32), nullable=False),
+            Column("name", String(64), nullable=False),
+            Column("turn", Integer),
+            Column("rules", String(128), nullable=False),
+            Column("excerpt", Text),
+            Column("prompt", Text),
+            Column("verdict", String(16), nullable=False),
+            Column("reason", Text),
+            Column("model", String(64)),
+            Column("time", DateTime, nullable=False),
+        )
+        self.metadata = metadata
+        self.indexes = [
+            # (time, id) 키셋 페이지네이션
+            Index("qna_time_id_idx", self.qna.c.time.desc(), self.qna.c.id.desc()),
+            # 학번/이름 접두어 검색 (LIKE 'abc%')
+            Index("qna_number_idx", self.qna.c.number, postgresql_ops={"number": "text_pattern_ops"}),
+            Index("qna_name_idx", self.qna.c.name, postgresql_ops={"name": "text_pattern_ops"}),
+            Index("guard_flags_time_idx", self.flags.c.time.desc()),
+        ]
+
+    def ensure_schema(self):
+        from sqlalchemy import inspect, text
+
+        # 기존 테이블·인덱스는 그대로 두고 없는 것만 만든다
+        with self.engine.begin() as conn:
+            self.metadata.create_all(conn, checkfirst=True)
+            existing = {column["name"] for column in inspect(conn).get_columns("qna")}
+            for name in self.added_columns:
+                if name not in existing:
+                    column = self.qna.c[name]
+                    column_type = column.type.compile(dialect=conn.dialect)
+                    conn.execute(text(f"ALTER TABLE qna ADD COLUMN {name} {column_type}"))
+            for index in self.indexes:
+                index.create(conn, checkfirst=True)
+
+    def write_transcripts(self, records):
+        rows = []
+        for r in records:
+            fields = transcript_fields(r, self.transcript_format)
+            # 예전 테이블의 chat 열이 NOT NULL(json/jsonb 포함)이어도 들어가도록 빈 목록을 넣음
+            fields["chat"] = encode_chat(fields["chat"]) if fields["chat"] is not None else "[]"
+            rows.append({"number": r["number"], "name": r["name"], "time": r["time"], **fields})
+        # 여러 행을 한 트랜잭션의 다중 행 INSERT로 기록
+        with self.engine.begin() as conn:
+            conn.execute(self.qna.insert(), rows)
+
+    def write_feedback(self, records):
+        rows = [
+            {"number": r["number"], "name": r["name"], "feedback": r["feedback"], "time": r["time"]}
+            for r in records
+        ]
+        with self.engine.begin() as conn:
+            conn.execute(self.feedback.insert(), rows)
+
+    def write_flags(self, records):
+        rows = [{**r, "rules": ",".join(r["rules"])} for r in records]
+        with self.engine.begin() as conn:
+            conn.execute(self.flags.insert(), rows)
+
+    def _conditions(self, number, name, date_from, date_to, table=None):
+        table = self.qna if table is None else table
+        conditions = []
+        if number:
+            conditions.append(table.c.number.like(_prefix_pattern(number), escape="/"))
+        if name:
+            conditions.append(table.c.name.like(_prefix_pattern(name), escape="/"))
+        if date_from:
+            conditions.append(table.c.time >= datetime.combine(date_from, dt_time.min))
+        if date_to:
+            conditions.append(table.c.time < _day_end(date_to))
+        return conditions
+
+    def list_flags(self, number="", name="", date_from=None, date_to=None, limit=200):
+        from sqlalchemy import select
+
+        flags = self.flags
+        query = (
+            select(flags)
+            .where(*self._conditions(number, name, date_from, date_to, flags))
+            .order_by(flags.c.time.desc(), flags.c.id.desc())
+            .limit(limit)
+        )
+        with self.read_engine.connect() as conn:
+            rows = [dict(row._mapping) for row in conn.execute(query)]
+        for row in rows:
+            row["rules"] = row["rules"].split(",")
+        return rows
+
+    def list_records(self, cursor=None, number="", name="", date_from=None, date_to=None, limit=50):
+        from sqlalchemy import select, tuple_
+
+        qna = self.qna
+        query = select(qna.c.id, qna.c.number, qna.c.name, qna.c.time, qna.c.turns)
+        query = query.where(*self._conditions(number, name, date_from, date_to))
+        if cursor is not None:
+            query = query.where(tuple_(qna.c.time, qna.c.id) < tuple_(*cursor))
+        # limit+1개를 가져와 다음 페이지 존재 여부를 판단
+        query = query.order_by(qna.c.time.desc(), qna.c.id.desc()).limit(limit + 1)
+
+        with self.read_engine.connect() as conn:
+            records = [
+                {"id": row.id, "number": row.number, "name": row.name, "time": row.time, "turns": row.turns}
+                for row in conn.execute(query)
+            ]
+        return records[:limit], len(records) > limit
+
+    def watermark(self):
+        from sqlalchemy import func, select
+
+        # 기본키/시간 인덱스만 읽는 가벼운 쿼리
+        with self.read_engine.connect() as conn:
+            row = conn.execute(select(func.max(self.qna.c.id), func.max(self.qna.c.time))).fetchone()
+        return (row[0], row[1])
+
+    def get_chat(self, record_id):
+        from sqlalchemy import select
+
+        qna = self.qna
+        with self.read_engine.connect() as conn:
+            row = conn.execute(
+                select(qna.c.chat, qna.c.chat_blob, qna.c.format).where(qna.c.id == record_id)
+            ).fetchone()
+        return read_transcript(row.chat, row.chat_blob, row.format) if row else None
+
+    def get_summary(self, record_id):
+        from sqlalchemy import select
+
+        with self.read_engine.connect() as conn:
+            return conn.execute(select(self.qna.c.summary).where(self.qna.c.id == record_id)).scalar()
+
+    def iter_transcript_batches(self, number="", name="", date_from=None, date_to=None, batch_size=500):
+        from sqlalchemy import select
+
+        qna = self.qna
+        query = (
+            select(
+                qna.c.id, qna.c.number, qna.c.name, qna.c.time, qna.c.started, qna.c.finished,
+                qna.c.turns, qna.c.summary, qna.c.format, qna.c.chat, qna.c.chat_blob,
+            )
+            .where(*self._conditions(number, name, date_from, date_to))
+            .order_by(qna.c.time, qna.c.id)
+        )
+        # stream_results: PostgreSQL은 이름 있는 커서, MySQL은 SSCursor로 batch_size개씩 받아 옴
+        with self.read_engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+            for rows in result.partitions():
+                batch = []
+                for row in rows:
+                    chat, summary = read_transcript_summary(row.chat, row.chat_blob, row.format, row.summary)
+                    batch.append({
+                        "id": row.id, "number": row.number, "name": row.name, "time": row.time,
+                        "started": row.started, "finished": row.finished, "turns": row.turns,
+                        "summary": summary, "chat": chat,
+                    })
+                yield batch
+
+
+class SQLiteStorage(SQLStorage):
+    # 오프라인 교실이나 단일 서버 배포용 로컬 파일
+    name = "sqlite"
+
+    def __init__(self, path, transcript_format=FORMAT_COMPACT_V1):
+        from sqlalchemy import create_engine, event
+
+        engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+        @event.listens_for(engine, "connect")
+        def _configure(dbapi_connection, _record):
+            # 저장 워커가 쓰는 동안에도 교사 앱이 읽을 수 있도록 WAL 사용
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA busy_timeout=5000")
+            cursor.close()
+
+        super().__init__(engine, transcript_format=transcript_format)
+        self.ensure_schema()
+
+    def close(self):
+        self.engine.dispose()
+
+
+# --- MongoDB ---
+
+class MongoStorage(StorageBackend):
+    name = "mongo"
+
+    def __init__(self, database, collection="qna", feedback_collection="feedback",
+                 transcript_format=FORMAT_COMPACT_V1, flags_collection="guard_flags"):
+        self.qna = database[collection]
+        self.feedback = database[feedback_collection]
+        self.flags = database[flags_collection]
+        self.transcript_format = transcript_format
+
+    def ensure_schema(self):
+        self.qna.create_index([("time", -1), ("_id", -1)], name="qna_time_id_idx")
+        self.qna.create_index("number", name="qna_number_idx")
+        self.qna.create_index("name", name="qna_name_idx")
+        self.flags.create_index([("time", -1)], name="guard_flags_time_idx")
+
+    def write_transcripts(self, records):
+        documents = []
+        for record in records:
+            fields = transcript_fields(record, self.transcript_format)
+            if fields["chat"] is None:
+                del fields["chat"]
+            if fields["chat_blob"] is None:
+                del fields["chat_blob"]
+            # 새 문서를 만들어 넘기므로 insert_many가 붙이는 _id가 저널 기록에 섞이지 않음
+            documents.append({"number": record["number"], "name": record["name"], "time": record["time"], **fields})
+        self.qna.insert_many(documents, ordered=False)
+
+    def write_feedback(self, records):
+        self.feedback.insert_many([dict(record) for record in records], ordered=False)
+
+    def write_flags(self, records):
+        self.flags.insert_many([dict(record) for record in records], ordered=False)
+
+    def list_flags(self, number="", name="", date_from=None, date_to=None, limit=200):
+        conditions = self._conditions(number, name, date_from, date_to)
+        documents = self.flags.find({"$and": conditions} if conditions else {}).sort([("time", -1), ("_id", -1)]).limit(limit)
+        records = []
+        for doc in documents:
+            doc["id"] = str(doc.pop("_id"))
+            records.append(doc)
+        return records
+
+    @staticmethod
+    def _conditions(number, name, date_from, date_to):
+        conditions = []
+        if number:
+            conditions.append({"number": {"$regex": "^" + re.escape(number)}})
+        if name:
+            conditions.append({"name": {"$regex": "^" + re.escape(name)}})
+        if date_from or date_to:
+            time_range = {}
+            if date_from:
+                time_range["$gte"] = datetime.combine(date_from, dt_time.min)
+            if date_to:
+                time_range["$lt"] = _day_end(date_to)
+            conditions.append({"time": time_range})
+        return conditions
+
+    def list_records(self, cursor=None, number="", name="", date_from=None, date_to=None, limit=50):
+        from bson import ObjectId
+
+        conditions = self._conditions(number, name, date_from, date_to)
+        if cursor is not None:
+            cursor_time, cursor_id = cursor[0], ObjectId(cursor[1])
+            conditions.append({"$or": [
+                {"time": {"$lt": cursor_time}},
+                {"time": cursor_time, "_id": {"$lt": cursor_id}},
+            ]})
+        query = {"$and": conditions} if conditions else {}
+
+        documents = (
+            self.qna.find(query, {"number": 1, "name": 1, "time": 1, "turns": 1})
+            .sort([("time", -1), ("_id", -1)])
+            .limit(limit + 1)
+        )
+        records = [
+            {"id": str(doc["_id"]), "number": doc.get("number", ""), "name": doc.get("name", ""),
+             "time": doc.get("time"), "turns": doc.get("turns")}
+            for doc in documents
+        ]
+        return records[:limit], len(records) > limit
+
+    def watermark(self):
+        latest = self.qna.find_one({}, {"time": 1}, sort=[("_id", -1)])
+        return (str(latest["_id"]), latest.get("time")) if latest else (None, None)
+
+    def get_chat(self, record_id):
+        from bson import ObjectId
+
+        document = self.qna.find_one({"_id": ObjectId(record_id)}, {"chat": 1, "chat_blob": 1, "format": 1})
+        if document is None:
+            return None
+        return read_transcript(document.get("chat"), document.get("chat_blob"), document.get("format"))
+
+    def get_summary(self, record_id):
+        from bson import ObjectId
+
+        document = self.qna.find_one({"_id": ObjectId(record_id)}, {"summary": 1})
+        return document.get("summary") if document else None
+
+    def iter_transcript_batches(self, number="", name="", date_from=None, date_to=None, batch_size=500):
+        conditions = self._conditions(number, name, date_from, date_to)
+        documents = (
+            self.qna.find({"$and": conditions} if conditions else {})
+            .sort([("time", 1), ("_id", 1)])
+            .batch_size(batch_size)
+        )
+        batch = []
+        try:
+            for doc in documents:
+                chat, summary = read_transcript_summary(
+                    doc.get("chat"), doc.get("chat_blob"), doc.get("format"), doc.get("summary")
+                )
+                batch.append({
+                    "id": str(doc["_id"]), "number": doc.get("number", ""), "name": doc.get("name", ""),
+                    "time": doc.get("time"), "started": doc.get("started"), "finished": doc.get("finished"),
+                    "turns": doc.get("turns"), "summary": summary, "chat": chat,
+                })
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            documents.close()
+
+
+@st.cache_resource(show_spinner=False)
+def get_storage(backend=None):
+    # backend를 지정하지 않으면 STORAGE_BACKEND, 그것도 없으면 기존 배포와 같게:
+    # DATABASE_URL이 있으면 SQL, 아니면 MongoDB.
+    # 교사 앱은 자신의 백엔드만 읽으므로, 학생 앱과 STORAGE_BACKEND가 다르면 기록과 답 노출 판정이
+    # 교사 앱에 보이지 않는다. 판정만이라도 교사 앱 쪽에 쓰려면 학생 앱에 FLAGS_STORAGE_BACKEND를 둔다
+    from inq_clients import get_mongo_client, get_readonly_engine, get_sql_engine
+
+    # 기본은 예전 형식(JSON 목록, chat 필드). 학생 앱(Mongo 기본)과 교사 앱(PostgreSQL) 사이에서
+    # 기록을 옮기는 작업이나 예전 형식을 읽는 앱은 chat 필드만 본다.
+    # 두 앱이 같은 STORAGE_BACKEND를 쓰게 된 뒤에 TRANSCRIPT_FORMAT=1(압축 형식)로 바꾼다.
+    transcript_format = int(st.secrets.get("TRANSCRIPT_FORMAT", FORMAT_LEGACY))
+    if backend is None:
+        backend = st.secrets.get("STORAGE_BACKEND")
+    if backend is None:
+        backend = "sql" if "DATABASE_URL" in st.secrets else "mongo"
+
+    if backend == "sql":
+        url = st.secrets.get("STORAGE_URL") or st.secrets["DATABASE_URL"]
+        storage = SQLStorage(get_sql_engine(url), get_readonly_engine(url), transcript_format)
+    elif backend == "sqlite":
+        storage = SQLiteStorage(st.secrets.get("STORAGE_PATH", "inq_storage.sqlite3"), transcript_format)
+    elif backend == "mongo":
+        storage = MongoStorage(
+            get_mongo_client()[st.secrets["MONGO_DB"]],
+            collection=st.secrets.get("MONGO_COLLECTION", "qna"),
+            feedback_collection=st.secrets.get("MONGO_COLLECTION_FEEDBACK", "feedback"),
+            transcript_format=transcript_format,
+            flags_collection=st.secrets.get("MONGO_COLLECTION_FLAGS", "guard_flags"),
+        )
+    else:
+        raise ValueError(f"알 수 없는 STORAGE_BACKEND: {backend!r}")
+    logger.info("저장소 백엔드: %s", storage.name)
+    return storage
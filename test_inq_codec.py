@@ -0,0 +1,128 @@
+import json
+import zlib
+
+import pytest
+
+import inq_codec
+from inq_codec import (
+    CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD, FORMAT_COMPACT_V1, FORMAT_LEGACY, MAGIC, decode_transcript,
+    encode_transcript,
+)
+from inq_storage import read_transcript, read_transcript_summary, transcript_fields
+
+# 저장된 기록은 되돌릴 수 없으므로, 형식이 바뀌면 예전 기록을 그대로 읽는지 여기서 확인한다
+
+SHORT = [{"role": "user", "content": "안녕"}]
+LONG = [
+    {"role": "user", "content": "이차방정식 $x^2 - 5x + 6 = 0$ 을 어떻게 풀어야 할까요?"},
+    {"role": "assistant", "content": "인수분해를 떠올려 보세요. 곱해서 6, 더해서 -5가 되는 두 수는 무엇일까요? " * 20},
+    {"role": "system", "content": "요약: 학생이 근과 계수의 관계를 탐구함.\n\\frac{1}{2}, \"따옴표\", 이모지 🧠"},
+    {"role": "user", "content": ""},
+]
+
+
+@pytest.fixture
+def no_zstd(monkeypatch):
+    monkeypatch.setattr(inq_codec, "_zstd", lambda: None)
+
+
+def _header(blob):
+    assert blob[:2] == MAGIC
+    return blob[2], blob[3]
+
+
+def test_short_body_is_stored_uncompressed():
+    blob = encode_transcript(SHORT)
+    assert _header(blob) == (FORMAT_COMPACT_V1, CODEC_NONE)
+    assert decode_transcript(blob) == SHORT
+
+
+def test_zlib_round_trip(no_zstd):
+    blob = encode_transcript(LONG)
+    assert _header(blob) == (FORMAT_COMPACT_V1, CODEC_ZLIB)
+    assert decode_transcript(blob) == LONG
+    # 본문은 표준 zlib 스트림이어야 다른 도구로도 꺼낼 수 있다
+    assert json.loads(zlib.decompress(blob[4:]))[0] == ["u", LONG[0]["content"]]
+
+
+def test_zstd_round_trip():
+    pytest.importorskip("zstandard")
+    blob = encode_transcript(LONG)
+    assert _header(blob) == (FORMAT_COMPACT_V1, CODEC_ZSTD)
+    assert decode_transcript(blob) == LONG
+
+
+def test_zstd_blob_without_zstandard_fails_loudly(monkeypatch):
+    pytest.importorskip("zstandard")
+    blob = encode_transcript(LONG)
+    monkeypatch.setattr(inq_codec, "_zstd", lambda: None)
+    with pytest.raises(RuntimeError):
+        decode_transcript(blob)
+
+
+def test_decodes_stored_v1_zlib_blob():
+    # 형식 1로 이미 저장된 기록: 인코더가 바뀌어도 이 바이트열은 계속 읽혀야 한다
+    blob = bytes.fromhex(
+        "4951010178da8b8e562a55d251aa883352d05530ad50d0563053b05530507833b741e1cdb42dafa7ed7eb5a947e1eda486"
+        "573b7bdecc9a62af14ab13ad9408d4f16af3c6b753b7bc6999a360a6a3f0ba770a94a36bfa6a4383c2eb09335e774d51"
+        "783d7182c29b8e19af97ee5178b361df9ba92daf370315ed009aa3a730aa7f68eb578a8d0500d8ac4a84"
+    )
+    assert decode_transcript(blob) == [
+        {"role": "user", "content": "x^2 - 5x + 6 = 0 은 어떻게 풀까요?"},
+        {"role": "assistant", "content": "곱해서 6, 더해서 -5가 되는 두 수를 찾아보세요. " * 8},
+    ]
+
+
+def test_decode_accepts_memoryview():
+    # DB 드라이버에 따라 bytea/BLOB 열이 memoryview로 들어온다
+    assert decode_transcript(memoryview(encode_transcript(LONG))) == LONG
+
+
+def test_unknown_role_is_kept():
+    messages = [{"role": "tool", "content": "x" * 300}]
+    assert decode_transcript(encode_transcript(messages)) == messages
+
+
+@pytest.mark.parametrize("blob", [b"", b"XX\x01\x00[]", MAGIC + bytes([9, CODEC_NONE]) + b"[]",
+                                  MAGIC + bytes([FORMAT_COMPACT_V1, 7]) + b"[]"])
+def test_decode_rejects_unknown_headers(blob):
+    with pytest.raises(ValueError):
+        decode_transcript(blob)
+
+
+@pytest.mark.parametrize("chat", [json.dumps(LONG, ensure_ascii=False), json.dumps(LONG).encode("utf-8"), LONG])
+@pytest.mark.parametrize("fmt", [FORMAT_LEGACY, None])
+def test_legacy_rows_read_as_before(chat, fmt):
+    # 예전 행: format이 0 또는 NULL이고 chat이 text / bytes / jsonb(리스트)
+    assert read_transcript(chat, None, fmt) == LONG
+
+
+def test_legacy_row_without_chat():
+    assert read_transcript(None, None, FORMAT_LEGACY) is None
+
+
+@pytest.mark.parametrize("transcript_format", [FORMAT_LEGACY, FORMAT_COMPACT_V1])
+def test_transcript_fields_round_trip(transcript_format):
+    record = {"chat": LONG, "summary": "피드백"}
+    fields = transcript_fields(record, transcript_format)
+    assert fields["format"] == transcript_format
+    assert fields["turns"] == 2
+    chat = read_transcript(fields["chat"], fields["chat_blob"], fields["format"])
+    if transcript_format == FORMAT_LEGACY:
+        # 예전 형식은 요약을 마지막 assistant 메시지로만 붙인다 (summary 열에 또 넣지 않음)
+        assert chat == LONG + [{"role": "assistant", "content": "피드백"}]
+        assert fields["summary"] is None
+    else:
+        assert fields["chat"] is None
+        assert chat == LONG
+        assert fields["summary"] == "피드백"
+    # 내보내기·통계에는 어느 형식이든 요약이 한 번만 나온다
+    assert read_transcript_summary(fields["chat"], fields["chat_blob"], fields["format"], fields["summary"]) == (
+        LONG, "피드백"
+    )
+
+
+def test_legacy_row_with_summary_in_both_places():
+    # summary 열과 chat 양쪽에 요약이 들어간 예전 행도 한 번만 돌려준다
+    chat = json.dumps(LONG + [{"role": "assistant", "content": "피드백"}], ensure_ascii=False)
+    assert read_transcript_summary(chat, None, FORMAT_LEGACY, "피드백") == (LONG, "피드백")